@@ -1,5 +1,3 @@
-print("Running __init__")
-
 if __name__ == '__main__':
     def main():
         print("Running main()")
\ No newline at end of file
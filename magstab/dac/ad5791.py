@@ -1,5 +1,9 @@
+import functools
+import os
 import sys
+import threading
 import time
+import weakref
 from ..external import redpitaya_scpi as scpi
 
 
@@ -11,6 +15,7 @@ AD5791_INFO = False
 
 def _DEBUG(*args, **kwargs):
     if AD5791_DEBUG:
+        _enable_colors()
         print(*args, **kwargs)
     else:
         pass
@@ -21,9 +26,17 @@ def _INFO(*args, **kwargs):
     else:
         pass
 
-# for colors in terminal
-import os
-os.system('color')
+# for colors in terminal: the Windows console only interprets them after running "color",
+# done once debugging output is actually printed rather than when importing
+_colors_enabled = False
+
+def _enable_colors():
+    global _colors_enabled
+    if not _colors_enabled:
+        _colors_enabled = True
+        if sys.platform == 'win32':
+            os.system('color')
+
 COLOR_RED       = "\x1b[31m"
 COLOR_BOLD_RED  = "\x1b[31;1m"
 COLOR_GREEN     = "\x1b[32m"
@@ -132,6 +145,57 @@ def _volt_to_code(voltage: float, Vrefp=VREFP, Vrefn=VREFN, nbits=20, is_two_com
             code = code ^ (1 << (nbits-1))
         return code
 
+def _volt_to_code_array(voltages, Vrefp=VREFP, Vrefn=VREFN, nbits=20, is_two_complement=True):
+    '''Vectorized _volt_to_code(): converts an array of voltages to an array of 20-bit codes (uint32),
+    with the same scaling and rounding as _volt_to_code()
+    '''
+    import numpy as np
+    voltages = np.asarray(voltages, dtype=np.float64)
+    assert np.all((Vrefn <= voltages) & (voltages <= Vrefp))
+    codes = ((voltages - Vrefn) * float(2**nbits - 1) / (Vrefp - Vrefn)).astype(np.uint32)
+    assert np.all(codes < 2**nbits)
+    if is_two_complement:
+        codes ^= np.uint32(1 << (nbits-1))
+    return codes
+
+def _code_to_volt_array(codes, Vrefp=VREFP, Vrefn=VREFN, nbits=20, is_two_complement=True):
+    '''Vectorized _code_to_volt(): converts an array of 20-bit codes to an array of voltages (float64)
+    '''
+    import numpy as np
+    codes = np.asarray(codes, dtype=np.uint32)
+    if is_two_complement:
+        codes = codes ^ np.uint32(1 << (nbits-1))
+    assert np.all(codes < 2**nbits)
+    return (Vrefp - Vrefn) * codes.astype(np.float64) / float(2**nbits - 1) + Vrefn
+
+def _codes_to_frames(codes):
+    '''Vectorized _code_to_tuple(): converts an array of n 24-bit codes to an (n, 3) array of bytes (uint8),
+    most significant byte first, i.e. frames.tobytes() is the SPI data of the n frames
+    '''
+    import numpy as np
+    codes = np.asarray(codes, dtype=np.uint32).reshape(-1)    # a scalar is one frame
+    assert np.all(codes < 2**24)
+    return codes.astype('>u4').view(np.uint8).reshape(-1, 4)[:, 1:]
+
+def _frames_to_codes(frames):
+    '''Vectorized _tuple_to_code(): converts an (n, 3) array of bytes, or 3n bytes, to an array of n 24-bit codes (uint32)
+    '''
+    import numpy as np
+    if isinstance(frames, (bytes, bytearray, memoryview)):
+        frames = np.frombuffer(frames, dtype=np.uint8)
+    frames = np.asarray(frames, dtype=np.uint32).reshape(-1, 3)
+    return (frames[:, 0] << 16) | (frames[:, 1] << 8) | frames[:, 2]
+
+def _parse_read_array(buffs):
+    '''Vectorized _parse_read(): converts replies like "{255,255,255}" (e.g. the SPI:MSG<n>:RX? replies
+    of scpi.txrx_batch()) to an array of 24-bit codes (uint32)
+    '''
+    import numpy as np
+    if not buffs:
+        return np.zeros(0, dtype=np.uint32)
+    words = ','.join([buff.strip('{}') for buff in buffs]).split(',')
+    return _frames_to_codes(np.array(words, dtype=np.uint32))
+
 def _is_bit_in_code(c: int, b:int) -> bool:
     _ = c & b    # test if at least one bit in b is in c
     return _ == b   # only return True if not only b is in c but also b doesn't contain bits not in c
@@ -183,85 +247,302 @@ AD5791_MASK_CLR  = AD5791_MASK_DATA
 AD5791_MASK_SFT  = AD5791_BIT_RESET | AD5791_BIT_CLEAR | AD5791_BIT_LDAC
 
 
-    
 
-    
-    
-    
+
+def _operation(name):
+    '''Decorator accounting each call of a DAC method as one operation in the transport statistics
+    (see scpi.stats()), e.g. to count the round trips of a V write or of a reg_ctl read-modify-write
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            with self.rp_s.operation(name):
+                return f(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def _init_msgs(spi_dev='/dev/spidev1.0', spi_speed=SPI_SPEED) -> list:
+    '''Returns the SCPI commands opening and configuring the SPI device of the DAC
+    '''
+    return [
+        'SPI:INIT:DEV "{0}"'.format(spi_dev),
+        'SPI:SET:DEF',
+        'SPI:SET:GET',
+        'SPI:SET:MODE LIST',
+        'SPI:SET:SPEED {0:d}'.format(int(spi_speed)),
+        'SPI:SET:WORD 8',
+        'SPI:SET:SET',
+    ]
+
+def _transfer_msgs(codes, rx=(), binary=False) -> list:
+    '''Returns the SCPI commands sending one SPI message per code (24-bit frame, CS toggled after each),
+    then querying the codes read back during the frames whose indices are listed in rx.
+    With binary=True the frames are sent as raw bytes in definite length blocks: (command, data) tuples
+    for scpi.txrx_batch(), for servers accepting binary data in SPI:MSG<n>:TX<m>
+    '''
+    msgs = ['SPI:MSG:CREATE {0:d}'.format(len(codes))]
+    if binary:
+        msgs += [('SPI:MSG{0:d}:TX3:RX:CS'.format(i), c.to_bytes(3, 'big')) for i, c in enumerate(codes)]
+    else:
+        msgs += ['SPI:MSG{0:d}:TX3:RX:CS {1}'.format(i, _parse_write(c)) for i, c in enumerate(codes)]
+    msgs.append('SPI:PASS')
+    msgs += ['SPI:MSG{0:d}:RX?'.format(i) for i in rx]
+    msgs.append('SPI:MSG:DEL')
+    return msgs
+
+class _Transaction(object):
+    '''SPI message list of n frames prepared once on the server and reused by every transfer of n frames:
+    it is created when the connection does not hold it (rp_s.prepared), then each transfer only rewrites
+    the frames whose code changed since the previous one before SPI:PASS, and is never deleted.
+    The command strings are precompiled, only changed frames are rendered.
+    '''
+
+    def __init__(self, n: int, binary=False):
+        self.n = n
+        self.binary = binary
+        self._create = 'SPI:MSG:CREATE {0:d}'.format(n)
+        if binary:
+            self._tx = ['SPI:MSG{0:d}:TX3:RX:CS'.format(i) for i in range(n)]
+        else:
+            self._tx = ['SPI:MSG{0:d}:TX3:RX:CS '.format(i) for i in range(n)]
+        self._rx = ['SPI:MSG{0:d}:RX?'.format(i) for i in range(n)]
+        self._codes = [None] * n    # codes held by the server-side list, valid while rp_s.prepared is self
+
+    def msgs(self, rp_s, codes, rx=()) -> list:
+        '''Returns the SCPI commands sending codes (n frames) through the prepared list of connection rp_s,
+        then querying the codes read back during the frames whose indices are listed in rx.
+        To be called with rp_s.lock held, right before sending the commands.
+        '''
+        msgs = []
+        if rp_s.prepared is not self:
+            if rp_s.prepared is not None:
+                msgs.append('SPI:MSG:DEL')
+            msgs.append(self._create)
+            self._codes = [None] * self.n
+            rp_s.prepared = self
+        for i, c in enumerate(codes):
+            if c != self._codes[i]:
+                self._codes[i] = c
+                if self.binary:
+                    msgs.append((self._tx[i], c.to_bytes(3, 'big')))
+                else:
+                    msgs.append(self._tx[i] + _parse_write(c))
+        msgs.append('SPI:PASS')
+        msgs += [self._rx[i] for i in rx]
+        return msgs
+
+# allowed bits of the registers kept in the DAC shadow (software control register only holds actions)
+_REG_MASKS = {AD5791_REG_DAC: AD5791_MASK_DAC, AD5791_REG_CTL: AD5791_MASK_CTL, AD5791_REG_CLR: AD5791_MASK_CLR}
+
+# codes read back in one transaction by read_registers(): each frame returns the register requested by the previous one
+_READ_REGISTERS = (AD5791_REG_DAC, AD5791_REG_CTL, AD5791_REG_CLR, AD5791_REG_SFT)
+_READ_REGISTERS_NAMES = ('dac', 'ctl', 'clr', 'sft')
+_READ_REGISTERS_CODES = [AD5791_R | reg for reg in _READ_REGISTERS] + [AD5791_NOP]
+_READ_REGISTERS_RX = list(range(1, len(_READ_REGISTERS) + 1))
+
+
+
+
+def _verify_worker(dac_ref, event):
+    '''Background verification of DAC.V writes, holding only a weak reference to the DAC
+    '''
+    while True:
+        event.wait()
+        event.clear()
+        dac = dac_ref()
+        if dac is None:
+            return
+        try:
+            dac.verify()
+        except Exception as e:
+            print('AD5791 >> background verification failed: {!s:s}'.format(e))
+        del dac
+
+
+
+
 class DAC(object):
 
-    def __init__(self, ip=IP, port=PORT, default_voltage=4.876543, spi_speed=SPI_SPEED, spi_dev='/dev/spidev1.0'):
-        self.rp_s = scpi.scpi(ip)
-        messages_init = [
-            'SPI:INIT:DEV "{0}"'.format(spi_dev),
-            'SPI:SET:DEF',
-            'SPI:SET:GET',
-            'SPI:SET:MODE LIST',
-            'SPI:SET:SPEED {0:d}'.format(int(spi_speed)),
-            'SPI:SET:WORD 8',
-            'SPI:SET:SET',
-        ]
-
-        for msg in messages_init:
-            _DEBUG('*** __init__() ***', msg)
-            self.rp_s.tx_txt(msg)
-
-                
+    def __init__(self, ip=IP, port=PORT, default_voltage=4.876543, spi_speed=SPI_SPEED, spi_dev='/dev/spidev1.0', pool=scpi.POOL, binary_tx=False, max_age=None,
+                 write_only=False, verify_every=0, verify_background=False, on_mismatch=None, calibration=None,
+                 connection=None):
+        # connections are shared through the pool, unless a connection is given (e.g. a recording scpi
+        # or a redpitaya_scpi_replay.scpi_replay); the SPI setup is (re)sent by _txrx() whenever
+        # the server-side session is not ours, i.e. after a reconnect or another DAC used the connection
+        self._pool = pool if connection is None else None
+        self._spi_dev = spi_dev
+        self._spi_speed = spi_speed
+        self.binary_tx = binary_tx  # send SPI frames as binary blocks, only if the server accepts them
+        self._session = object()  # token marking the connection session as ours, without referencing self
+        # write-through shadow of the registers: reg --> (code as read back, time.monotonic() of last sync)
+        # reads are served from it unless unknown, older than max_age seconds (None: no bound) or verified
+        self._shadow = {}
+        self.max_age = max_age
+        self._transactions = {}  # (number of frames, binary) --> _Transaction prepared on the server
+        self.calibration = calibration  # calibration.Calibration of this DAC, None: ideal transfer from VREFP and VREFN
+        self.rp_s = pool.get(ip, int(port)) if connection is None else connection
+        self._txrx([])
+
+        self.read_registers()
         _DEBUG("AD5791_REG_DAC", pprint_code(self.reg_dac))
         _DEBUG("AD5791_REG_CTL", pprint_code(self.reg_ctl))
         _DEBUG("AD5791_REG_CLR", pprint_code(self.reg_clr))
         _DEBUG("AD5791_REG_SFT", pprint_code(self.reg_sft))
 
+        # V writes: write_only drops the readback frame; every verify_every-th write (0: never) is
+        # checked against a readback, in the same transaction or later from a background thread,
+        # and on_mismatch(expected, actual) is called with the codes if they differ
+        self.write_only = write_only
+        self.verify_every = verify_every
+        self.verify_background = verify_background
+        self.on_mismatch = on_mismatch
+        self.n_writes = 0
+        self.n_mismatches = 0
+        self._verify_event = None
+
         self._delayed_trig = False
-        self.reg_clr = _volt_to_code(default_voltage)
+        self.reg_clr = self._code(default_voltage)
 
     def __del__(self):
+        if getattr(self, '_verify_event', None) is not None:
+            self._verify_event.set()    # wakes the verification thread up, it exits as self is gone
+        rp_s = getattr(self, 'rp_s', None)
+        if rp_s is None:
+            return
         msg = 'SPI:RELEASE'
         _DEBUG('*** __del()__  **', msg)
-        self.rp_s.tx_txt(msg)
-
-
+        with rp_s.lock:
+            # only on the live connection holding our session: never reconnects just to release it
+            if rp_s.session is self._session:
+                rp_s.session = None
+                rp_s.prepared = None
+                if rp_s.is_alive():
+                    try:
+                        rp_s.tx_txt(msg)
+                    except OSError as e:
+                        print('AD5791 >> {0} failed: {1!s:s}'.format(msg, e))
+        if self._pool is not None:
+            self._pool.release(rp_s)
+
+    def _queue_session(self):
+        rp_s = self.rp_s
+        messages = []
+        if rp_s.prepared is not None:
+            messages.append('SPI:MSG:DEL')  # the list of the previous session is not kept across a device switch
+        if rp_s.spi_setup.get(self._spi_dev) is self._session:
+            # the device still has the settings of our previous session on this connection: only switch to it
+            messages.append('SPI:INIT:DEV "{0}"'.format(self._spi_dev))
+        else:
+            messages += _init_msgs(self._spi_dev, self._spi_speed)
+            rp_s.spi_setup[self._spi_dev] = self._session
+        for msg in messages:
+            _DEBUG('*** _queue_session() ***', msg)
+            rp_s.queue_txt(msg)
+        rp_s.session = self._session
+        rp_s.prepared = None   # the message list is created again in the new SPI setup
+
+    def _txrx(self, msgs):
+        '''Sends msgs in a single pipelined write, preceded by the SPI setup if the session is not ours.
+        msgs can also be a function returning the commands, called once the session is set up
+        (e.g. for commands depending on the server-side state, see _Transaction).
+        On a connection error, reconnects, replays the SPI setup and sends msgs again (once).
+        Returns the replies to the queries in msgs.
+        '''
+        with self.rp_s.lock:
+            try:
+                if not self.rp_s.is_alive():  # catches a dropped connection before a write-only batch is lost
+                    self.rp_s.reconnect()
+                if self.rp_s.session is not self._session:
+                    self._queue_session()
+                return self.rp_s.txrx_batch(msgs() if callable(msgs) else msgs)
+            except OSError as e:
+                print('AD5791 >> {!s:s}, reconnecting'.format(e))
+                self.rp_s.reconnect()
+                self._queue_session()
+                return self.rp_s.txrx_batch(msgs() if callable(msgs) else msgs)
+
+
+
+    def read_reg(self, reg: int, verify=False) -> int:
+        '''Returns register reg as read back (address bits included), from the shadow
+        unless it is unknown, older than max_age seconds or verify is True
+        '''
+        if not verify:
+            c, t = self._shadow.get(reg, (None, 0.0))
+            if c is not None and (self.max_age is None or time.monotonic() - t <= self.max_age):
+                return c
+        return self.r_single(AD5791_R | reg)
+
+    def invalidate(self, reg=None):
+        '''Forgets the shadow of register reg (all registers if None), so that its next read touches hardware
+        '''
+        if reg is None:
+            self._shadow.clear()
+        else:
+            self._shadow.pop(reg, None)
+
+    def _shadow_write(self, c: int):
+        '''Keeps the register shadow coherent with a frame c written to the DAC
+        '''
+        if c & AD5791_MASK_RW == AD5791_R:
+            return
+        reg = c & AD5791_MASK_REG
+        if reg == AD5791_REG_SFT:
+            if c & AD5791_BIT_RESET:
+                self._shadow.clear()
+            elif c & AD5791_BIT_CLEAR:
+                self._shadow.pop(AD5791_REG_DAC, None)
+        elif reg in _REG_MASKS:
+            self._shadow[reg] = (reg | (c & _REG_MASKS[reg]), time.monotonic())
 
     @property
+    @_operation('DAC.reg_dac')
     def reg_dac(self):
-        c = self.r_single(AD5791_R | AD5791_REG_DAC)
+        c = self.read_reg(AD5791_REG_DAC)
         assert _is_bit_in_code(AD5791_REG_DAC | AD5791_MASK_DAC, c)
         return c
 
     @reg_dac.setter
+    @_operation('DAC.reg_dac=')
     def reg_dac(self, c: int):
         assert _is_bit_in_code(AD5791_MASK_DAC, c)
         self.w_single(AD5791_W | AD5791_REG_DAC | c)
 
     @property
+    @_operation('DAC.reg_ctl')
     def reg_ctl(self):
-        c = self.r_single(AD5791_R | AD5791_REG_CTL)
+        c = self.read_reg(AD5791_REG_CTL)
         assert _is_bit_in_code(AD5791_REG_CTL | AD5791_MASK_CTL, c)
         return c
 
     @reg_ctl.setter
+    @_operation('DAC.reg_ctl=')
     def reg_ctl(self, c: int):
         assert _is_bit_in_code(AD5791_MASK_CTL, c)
         self.w_single(AD5791_W | AD5791_REG_CTL | c)
 
     @property
+    @_operation('DAC.reg_clr')
     def reg_clr(self):
-        c = self.r_single(AD5791_R | AD5791_REG_CLR)
+        c = self.read_reg(AD5791_REG_CLR)
         assert _is_bit_in_code(AD5791_REG_CLR | AD5791_MASK_CLR, c)
         return c
 
     @reg_clr.setter
+    @_operation('DAC.reg_clr=')
     def reg_clr(self, c: int):
         assert _is_bit_in_code(AD5791_MASK_CLR, c)
         self.w_single(AD5791_W | AD5791_REG_CLR | c)
 
     @property
+    @_operation('DAC.reg_sft')
     def reg_sft(self):
-        c = self.r_single(AD5791_R | AD5791_REG_SFT)
+        c = self.read_reg(AD5791_REG_SFT)
         assert _is_bit_in_code(AD5791_REG_SFT | AD5791_MASK_SFT, c)
         return c
 
     @reg_sft.setter
+    @_operation('DAC.reg_sft=')
     def reg_sft(self, c: int):
         assert _is_bit_in_code(AD5791_MASK_SFT, c)
         self.w_single(AD5791_W | AD5791_REG_SFT | c)
@@ -272,10 +553,12 @@ class DAC(object):
 
 
     @property
+    @_operation('DAC.tristate')
     def tristate(self) -> bool:
         return _is_bit_in_code(self.reg_ctl, AD5791_BIT_DACTRI)
 
     @tristate.setter
+    @_operation('DAC.tristate=')
     def tristate(self, is_yes: bool) -> None:
         assert is_yes in [True, False]
         if is_yes:
@@ -284,10 +567,12 @@ class DAC(object):
             self.reg_ctl = _set_bit_to_false(self.reg_ctl, AD5791_BIT_DACTRI) & AD5791_MASK_DATA
 
     @property
+    @_operation('DAC.op_gnd')
     def op_gnd(self):
         return _is_bit_in_code(self.reg_ctl, AD5791_BIT_OPGND)
 
     @op_gnd.setter
+    @_operation('DAC.op_gnd=')
     def op_gnd(self, is_yes: bool):
         assert is_yes in [True, False]
         if is_yes:
@@ -298,12 +583,15 @@ class DAC(object):
 
 
 
+    @_operation('DAC.soft_ldac')
     def soft_ldac(self):
         self.reg_sft = AD5791_BIT_LDAC
 
+    @_operation('DAC.soft_reset')
     def soft_reset(self):
         self.reg_sft = AD5791_BIT_RESET
 
+    @_operation('DAC.soft_clear')
     def soft_clear(self):
         self.reg_sft = AD5791_BIT_CLEAR
 
@@ -311,120 +599,90 @@ class DAC(object):
 
 
 
-    def w_single(self, c: int):
-        _DEBUG("*** w_single() *** ")
+    def _code(self, v: float) -> int:
+        if self.calibration is None:
+            return _volt_to_code(v)
+        return self.calibration.volt_to_code(v)
 
-        msg = 'SPI:MSG:CREATE 2'
-        # _DEBUG(msg)
-        self.rp_s.tx_txt(msg)
+    def _codes(self, samples):
+        if self.calibration is None:
+            return _volt_to_code_array(samples)
+        return self.calibration.volt_to_code_array(samples)
 
-        msg = 'SPI:MSG0:TX3:RX:CS {0}'.format(_parse_write(c))
+    def _volt(self, c: int) -> float:
+        if self.calibration is None:
+            return _code_to_volt(c)
+        return self.calibration.code_to_volt(c)
 
-        _DEBUG(COLOR_GREEN, end='')
+    def _transaction(self, n: int):
+        key = (n, self.binary_tx)
+        transaction = self._transactions.get(key)
+        if transaction is None:
+            transaction = self._transactions[key] = _Transaction(*key)
+        return transaction
 
-        _DEBUG(msg, end="\t-->\t")
-        _DEBUG(pprint_code(c))
-        self.rp_s.tx_txt(msg)
+    def _queue_transfer(self, codes, rx=()):
+        '''Queues the commands of _transfer(codes, rx) on the connection, preceded by the SPI setup
+        if the session is not ours, to be sent with rp_s.flush() (e.g. together with other DACs, see DACGroup).
+        Call with rp_s.lock held.
+        '''
+        if self.rp_s.session is not self._session:
+            self._queue_session()
+        for msg in self._transaction(len(codes)).msgs(self.rp_s, codes, rx):
+            if isinstance(msg, tuple):
+                self.rp_s.queue_arb(*msg)
+            else:
+                self.rp_s.queue_txt(msg)
 
-        msg = 'SPI:MSG1:TX3:RX:CS {0}'.format(_parse_write(0))
-        _DEBUG(msg, end="\t-->\t")
-        _DEBUG(pprint_code(0))
-        self.rp_s.tx_txt(msg)
+    def _transfer(self, codes, rx=()):
+        '''Sends one SPI message per code (24-bit frame, CS toggled after each) in a single pipelined write,
+        through the message list of len(codes) frames prepared on the server.
+        Returns the codes read back during the frames whose indices are listed in rx.
+        '''
+        transaction = self._transaction(len(codes))
 
+        _DEBUG(COLOR_GREEN, end='')
+        for i, c in enumerate(codes):
+            _DEBUG('SPI:MSG{0:d}:TX3:RX:CS {1}'.format(i, code_to_hexstr(c)), end="\t-->\t")
+            _DEBUG(pprint_code(c))
         _DEBUG(COLOR_RESET, end='')
 
-
-        msg = 'SPI:PASS'
-        # _DEBUG(msg)
-        _INFO("PASS w_single()")
-        self.rp_s.tx_txt(msg)
+        rx_codes = [_parse_read(rx_buff) for rx_buff in self._txrx(lambda: transaction.msgs(self.rp_s, codes, rx))]
 
         _DEBUG(COLOR_YELLOW, end='')
-
-        if AD5791_DEBUG:
-            msg = 'SPI:MSG0:RX?'
-            _DEBUG(msg, end='')
-            self.rp_s.tx_txt(msg)
-            rx_buff = self.rp_s.rx_txt()
-            rx_code = _parse_read(rx_buff)
-            # _DEBUG(rx_buff)
+        for i, rx_code in zip(rx, rx_codes):
+            _DEBUG('SPI:MSG{0:d}:RX?'.format(i), end='')
             _DEBUG(" -->   {0}\t-->\t{1}".format(code_to_hexstr(rx_code), pprint_code(rx_code)))
+        _DEBUG(COLOR_RESET, end='')
 
-        if AD5791_DEBUG:
-            msg = 'SPI:MSG1:RX?'
-            _DEBUG(msg, end='')
-            self.rp_s.tx_txt(msg)
-            rx_buff = self.rp_s.rx_txt()
-            rx_code = _parse_read(rx_buff)
-            # _DEBUG(rx_buff)
-            _DEBUG(" -->   {0}\t-->\t{1}".format(code_to_hexstr(rx_code), pprint_code(rx_code)))
-
-            _DEBUG(COLOR_RESET, end='')
-
-        msg = 'SPI:MSG:DEL'
-        # _DEBUG(msg)
-        self.rp_s.tx_txt(msg)
-
-
-
-
+        return rx_codes
 
+    @_operation('DAC.w_single')
+    def w_single(self, c: int):
+        _DEBUG("*** w_single() *** ")
+        _INFO("PASS w_single()")
+        self._transfer([c, AD5791_NOP], rx=[0, 1] if AD5791_DEBUG else [])
+        self._shadow_write(c)
 
+    @_operation('DAC.r_single')
     def r_single(self, c: int):
         _DEBUG("*** r_single() *** ")
-
-        msg = 'SPI:MSG:CREATE 2'
-        # _DEBUG(msg)
-        self.rp_s.tx_txt(msg)
-
-        msg = 'SPI:MSG0:TX3:RX:CS {0}'.format(_parse_write(c))
-
-        _DEBUG(COLOR_GREEN, end='')
-
-        _DEBUG(msg, end="\t-->\t")
-        _DEBUG(pprint_code(c))
-        self.rp_s.tx_txt(msg)
-
-        msg = 'SPI:MSG1:TX3:RX:CS {0}'.format(_parse_write(AD5791_NOP))
-        _DEBUG(msg, end="\t-->\t")
-        _DEBUG(pprint_code(AD5791_NOP))
-        self.rp_s.tx_txt(msg)
-
-        _DEBUG(COLOR_RESET, end='')
-
-
-        msg = 'SPI:PASS'
-        # _DEBUG(msg)
         _INFO("PASS r_single()")
-        self.rp_s.tx_txt(msg)
-
-        _DEBUG(COLOR_YELLOW, end='')
-
-        if AD5791_DEBUG:
-            msg = 'SPI:MSG0:RX?'
-            _DEBUG(msg, end='')
-            self.rp_s.tx_txt(msg)
-            rx_buff = self.rp_s.rx_txt()
-            rx_code = _parse_read(rx_buff)
-            # _DEBUG(rx_buff)
-            _DEBUG(" -->   {0}\t-->\t{1}".format(code_to_hexstr(rx_code), pprint_code(rx_code)))
-
-        msg = 'SPI:MSG1:RX?'
-        _DEBUG(msg, end='')
-        self.rp_s.tx_txt(msg)
-        rx_buff = self.rp_s.rx_txt()
-        rx_code = _parse_read(rx_buff)
-        # _DEBUG(rx_buff)
-        _DEBUG(" -->   {0}\t-->\t{1}".format(code_to_hexstr(rx_code), pprint_code(rx_code)))
-
-        _DEBUG(COLOR_RESET, end='')
-
-        msg = 'SPI:MSG:DEL'
-        # _DEBUG(msg)
-        self.rp_s.tx_txt(msg)
-        
+        rx_code = self._transfer([c, AD5791_NOP], rx=[0, 1] if AD5791_DEBUG else [1])[-1]
+        if c & AD5791_MASK_RW == AD5791_R:
+            self._shadow[c & AD5791_MASK_REG] = (rx_code, time.monotonic())
         return rx_code
 
+    @_operation('DAC.read_registers')
+    def read_registers(self) -> dict:
+        '''Reads DAC, CTL, CLR and SFT registers in a single SPI transaction, and updates their shadow
+        '''
+        codes = self._transfer(_READ_REGISTERS_CODES, rx=_READ_REGISTERS_RX)
+        t = time.monotonic()
+        for reg, c in zip(_READ_REGISTERS, codes):
+            self._shadow[reg] = (c, t)
+        return dict(zip(_READ_REGISTERS_NAMES, codes))
+
     @property
     def delayed_trig(self) -> bool:
         return self._delayed_trig
@@ -435,79 +693,205 @@ class DAC(object):
         self._delayed_trig = is_yes
 
     @property
+    @_operation('DAC.V')
     def V(self):
-        return _code_to_volt(self.reg_dac & AD5791_MASK_DATA)
+        return self._volt(self.reg_dac & AD5791_MASK_DATA)
 
     @V.setter
+    @_operation('DAC.V=')
     def V(self, v):
-        msg = 'SPI:MSG:CREATE 3'
-        # _DEBUG(msg)
-        self.rp_s.tx_txt(msg)
-
-        c = _volt_to_code(v)
+        c = self._code(v)
         assert _is_bit_in_code(AD5791_MASK_DATA, c)
-        msg = 'SPI:MSG0:TX3:RX:CS {0}'.format(_parse_write(AD5791_W | AD5791_REG_DAC | c))
-        # _DEBUG(msg, end="\t--->\t")
-        # _DEBUG(pprint_code(c))
-        self.rp_s.tx_txt(msg)
-
-        msg = 'SPI:MSG1:TX3:RX:CS {0}'.format(_parse_write(AD5791_R | AD5791_REG_DAC))
-        # _DEBUG(msg, end="\t--->\t")
-        # _DEBUG(pprint_code(0))
-        self.rp_s.tx_txt(msg)
-
+        c_write = AD5791_W | AD5791_REG_DAC | c
         if self.delayed_trig:
-            msg = 'SPI:MSG2:TX3:RX:CS {0}'.format(_parse_write(AD5791_NOP))
+            c_trig = AD5791_NOP
         else:
-            msg = 'SPI:MSG2:TX3:RX:CS {0}'.format(_parse_write(AD5791_W | AD5791_REG_SFT | AD5791_BIT_LDAC))
-        # _DEBUG(msg, end="\t--->\t")
-        # _DEBUG(pprint_code(0))
-        self.rp_s.tx_txt(msg)
-
-        msg = 'SPI:PASS'
-        # _DEBUG(msg)
+            c_trig = AD5791_W | AD5791_REG_SFT | AD5791_BIT_LDAC
+        self.n_writes += 1
+        verify = bool(self.verify_every) and self.n_writes % self.verify_every == 0
         _INFO("PASS V()")
-        self.rp_s.tx_txt(msg)
-
-        if AD5791_DEBUG:
-            msg = 'SPI:MSG0:RX?'
-            # _DEBUG(msg, end='')
-            self.rp_s.tx_txt(msg)
-            rx_buff = self.rp_s.rx_txt()
-            rx_code = _parse_read(rx_buff)
-            # _DEBUG("\t\t--->\t{0}\t{1}".format(code_to_hexstr(rx_code), pprint_code(rx_code)))
-
-
-        if AD5791_DEBUG:
-            msg = 'SPI:MSG1:RX?'
-            # _DEBUG(msg, end='')
-            self.rp_s.tx_txt(msg)
-            rx_buff = self.rp_s.rx_txt()
-            rx_code = _parse_read(rx_buff)
-            # _DEBUG("\t\t--->\t{0}\t{1}".format(code_to_hexstr(rx_code), pprint_code(rx_code)))
-
-        if AD5791_DEBUG:
-            msg = 'SPI:MSG2:RX?'
-            # _DEBUG(msg, end='')
-            self.rp_s.tx_txt(msg)
-            rx_buff = self.rp_s.rx_txt()
-            rx_code = _parse_read(rx_buff)
-            # _DEBUG("\t\t--->\t{0}\t{1}".format(code_to_hexstr(rx_code), pprint_code(rx_code)))
-        
-        msg = 'SPI:MSG:DEL'
-        # _DEBUG(msg)
-        self.rp_s.tx_txt(msg)
+        with self.rp_s.lock:    # shadow and hardware change together for the verification thread
+            if verify and not self.verify_background:
+                # the readback frame comes out during the LDAC frame: verified in the same transaction
+                rx_code = self._transfer([c_write, AD5791_R | AD5791_REG_DAC, c_trig], rx=[0, 1, 2] if AD5791_DEBUG else [2])[-1]
+                self._shadow_write(c_write)
+                self._check_readback(AD5791_REG_DAC | c, rx_code)
+            elif self.write_only:
+                self._transfer([c_write, c_trig], rx=[0, 1] if AD5791_DEBUG else [])
+                self._shadow_write(c_write)
+            else:
+                self._transfer([c_write, AD5791_R | AD5791_REG_DAC, c_trig], rx=[0, 1, 2] if AD5791_DEBUG else [])
+                self._shadow_write(c_write)
+        if verify and self.verify_background:
+            self._request_verify()
+
+    def _check_readback(self, expected: int, actual: int):
+        if actual == expected:
+            return
+        self.n_mismatches += 1
+        if self.on_mismatch is not None:
+            self.on_mismatch(expected, actual)
+        else:
+            print('AD5791 >> readback mismatch: wrote {0}, read {1}'.format(code_to_hexstr(expected), code_to_hexstr(actual)))
+
+    def _request_verify(self):
+        if self._verify_event is None:
+            self._verify_event = threading.Event()
+            threading.Thread(target=_verify_worker, args=(weakref.ref(self), self._verify_event), daemon=True).start()
+        self._verify_event.set()   # requests made while a verification runs are merged into the next one
+
+    def verify(self) -> bool:
+        '''Reads the DAC register back and checks it against the last value written, returns True if they match
+        '''
+        with self.rp_s.lock:
+            expected = self._shadow.get(AD5791_REG_DAC, (None, 0.0))[0]
+            actual = self.read_reg(AD5791_REG_DAC, verify=True)
+        if expected is None:
+            return True
+        self._check_readback(expected, actual)
+        return actual == expected
+
+    @_operation('DAC.play')
+    def play(self, samples, rate: float, chunk=1024, stop=None) -> dict:
+        '''Plays a sequence of voltages at rate samples/s: each sample is a DAC write frame followed by an LDAC
+        frame, clocked out back to back with the SPI clock set to 2*24*rate during playback (restored after).
+        Samples are sent in chunks of up to chunk samples, each one SPI message list of 2*chunk frames
+        passed at once (the LDAC frames are only sent when the list is created). Chunks are double buffered:
+        chunk k+1 is uploaded before waiting for the *OPC? marker ending chunk k, so that the server starts
+        it without waiting for the host. An underrun is counted when chunk k had already ended before
+        chunk k+1 was uploaded, i.e. the output paused between them.
+        The connection is only locked while a chunk is uploaded: other DACs sharing it (same board)
+        are served between chunks, their commands running on the server after the chunks already passed.
+        stop: function called before each chunk, playback ends early when it returns True.
+        On a connection error, the connection is reopened. On any other exception (e.g. KeyboardInterrupt),
+        the chunks already uploaded end and their markers are received, the connection is kept.
+        Returns a dict with the numbers of samples, chunks and underruns, the duration (s, from the upload
+        of the first chunk to the end of the last one) and the achieved rate (samples/s).
+        '''
+        frames = _codes_to_frames(AD5791_W | AD5791_REG_DAC | self._codes(samples))
+        n = len(frames)
+        chunk = max(1, min(int(chunk), n))
+        c_ldac = AD5791_W | AD5791_REG_SFT | AD5791_BIT_LDAC
+        sep = '' if self.binary_tx else ' '
+        tx_dac = ['SPI:MSG{0:d}:TX3:RX:CS{1}'.format(2*i, sep) for i in range(chunk)]
+        tx_ldac = ['SPI:MSG{0:d}:TX3:RX:CS{1}'.format(2*i + 1, sep) for i in range(chunk)]
+        ldac = c_ldac.to_bytes(3, 'big') if self.binary_tx else _parse_write(c_ldac)
+        token = object()    # owner of the message list while playing (see _Transaction)
+
+        n_played = n_chunks = underruns = 0
+        pending = 0         # chunks uploaded whose end marker is not received yet
+        left = False        # pending markers left to the other users of the connection, see scpi.leave_replies()
+        size = None         # number of frames of the server-side message list
+        clock = self._spi_speed
+        rp_s = self.rp_s
+        self.clock_freq = 2 * 24 * rate
+        t_start = time.perf_counter()
+        done = False
+        try:
+            for k in range(0, n, chunk):
+                if stop is not None and stop():
+                    break
+                rows = frames[k:k + chunk]
+                m = len(rows)
+                # the connection is held chunk by chunk only: other DACs of the board use it in between,
+                # our markers still in flight are left to them (see scpi.leave_replies())
+                with rp_s.lock:
+                    pending = rp_s.take_replies(pending)
+                    left = False
+                    if rp_s.session is not self._session:
+                        self._queue_session()   # another DAC used the SPI meanwhile (with our playback clock)
+                    if rp_s.prepared is not token:
+                        size = None             # our message list was replaced
+                    if size != 2*m:
+                        if rp_s.prepared is not None:
+                            rp_s.queue_txt('SPI:MSG:DEL')
+                        rp_s.queue_txt('SPI:MSG:CREATE {0:d}'.format(2*m))
+                        rp_s.prepared = token
+                        size = 2*m
+                        for i in range(m):
+                            if self.binary_tx:
+                                rp_s.queue_arb(tx_ldac[i], ldac)
+                            else:
+                                rp_s.queue_txt(tx_ldac[i] + ldac)
+                    if self.binary_tx:
+                        data = rows.tobytes()
+                        for i in range(m):
+                            rp_s.queue_arb(tx_dac[i], data[3*i:3*i + 3])
+                    else:
+                        for i, (b0, b1, b2) in enumerate(rows.tolist()):
+                            rp_s.queue_txt('{0}#H{1:02X},#H{2:02X},#H{3:02X}'.format(tx_dac[i], b0, b1, b2))
+                    rp_s.queue_txt('SPI:PASS')
+                    rp_s.queue_txt('*OPC?')
+                    if pending and rp_s.rx_ready():
+                        underruns += 1
+                    rp_s.flush(wait=False)
+                    pending += 1
+                    n_chunks += 1
+                    n_played += m
+                    if pending == 2:
+                        rp_s.rx_txt()
+                        pending -= 1
+                    rp_s.leave_replies(pending)
+                    left = True
+            with rp_s.lock:
+                pending = rp_s.take_replies(pending)
+                left = False
+                rp_s.rx_txt_n(pending)
+                pending = 0
+            done = True
+        except OSError:
+            with rp_s.lock:
+                try:
+                    rp_s.reconnect()    # drops the replies still in flight
+                except OSError as e_reconnect:
+                    print('AD5791 >> play(): reconnect failed: {0!s:s}'.format(e_reconnect))
+            raise
+        except BaseException:
+            # e.g. KeyboardInterrupt: the connection is shared by the other DACs of the board, it is kept,
+            # only the commands of this playback still queued are sent and its markers in flight received
+            with rp_s.lock:
+                if left:
+                    pending = rp_s.take_replies(pending)
+                try:
+                    pending += rp_s.flush(wait=False)
+                    rp_s.rx_txt_n(pending)
+                except OSError as e:
+                    print('AD5791 >> play(): {0!s:s}, reconnecting'.format(e))
+                    try:
+                        rp_s.reconnect()
+                    except OSError as e_reconnect:
+                        print('AD5791 >> play(): reconnect failed: {0!s:s}'.format(e_reconnect))
+            raise
+        finally:
+            duration = time.perf_counter() - t_start
+            try:
+                self.clock_freq = clock
+            except OSError as e:
+                if done:
+                    raise
+                print('AD5791 >> play(): SPI clock not restored: {0!s:s}'.format(e))   # the original error is raised
+        if n_played:
+            self._shadow_write(AD5791_W | int(_frames_to_codes(frames[n_played - 1])[0]))
+        if underruns:
+            print('AD5791 >> play(): {0:d} underrun(s) in {1:d} chunks'.format(underruns, n_chunks))
+        return {
+            'samples': n_played,
+            'chunks': n_chunks,
+            'underruns': underruns,
+            'duration': duration,
+            'rate': n_played / duration if duration > 0 else 0.0,
+        }
 
 
 
 
 
     @property
+    @_operation('DAC.clock_freq')
     def clock_freq(self):
         msg = 'SPI:SET:SPEED?'
         _DEBUG(msg)
-        self.rp_s.tx_txt(msg)
-        rx_buff = self.rp_s.rx_txt()
+        rx_buff = self._txrx([msg])[0]
         _DEBUG(rx_buff)
         try:
             out = int(rx_buff)
@@ -517,6 +901,7 @@ class DAC(object):
             return out
 
     @clock_freq.setter
+    @_operation('DAC.clock_freq=')
     def clock_freq(self, freq: int):
         _DEBUG('*** clock_freq() ***')
         try:
@@ -527,8 +912,8 @@ class DAC(object):
                 ]
             for msg in messages:
                 _DEBUG(msg)
-                self.rp_s.tx_txt(msg)
+            self._txrx(messages)
         except:
             raise
         else:
-            pass
\ No newline at end of file
+            self._spi_speed = int(freq)  # replayed by _txrx() after a reconnect
\ No newline at end of file
@@ -0,0 +1,68 @@
+from ..external.redpitaya_scpi_async import scpi_async
+from .ad5791 import (
+    IP, PORT, SPI_SPEED,
+    AD5791_NOP, AD5791_W, AD5791_R,
+    AD5791_REG_DAC, AD5791_REG_CLR, AD5791_REG_SFT,
+    AD5791_BIT_LDAC, AD5791_MASK_DATA, AD5791_MASK_CLR,
+    _READ_REGISTERS_NAMES, _READ_REGISTERS_CODES, _READ_REGISTERS_RX,
+    _init_msgs, _transfer_msgs, _parse_read, _volt_to_code, _code_to_volt,
+)
+
+
+
+class AsyncDAC(object):
+    '''Asyncio facade of ad5791.DAC: every SPI transaction is one pipelined write (and one reply read
+    when something is read back), awaited without blocking the event loop.
+    Several AsyncDAC (one per board) can be driven concurrently, e.g.
+        dacs = await asyncio.gather(*[AsyncDAC.open(ip) for ip in ips])
+        await asyncio.gather(*[dac.set_voltage(v) for dac, v in zip(dacs, voltages)])
+    '''
+
+    def __init__(self, rp_s, delayed_trig=False, binary_tx=False):
+        self.rp_s = rp_s
+        self.delayed_trig = delayed_trig
+        self.binary_tx = binary_tx
+
+    @classmethod
+    async def open(cls, ip=IP, port=PORT, default_voltage=4.876543, spi_speed=SPI_SPEED, spi_dev='/dev/spidev1.0', timeout=None, binary_tx=False):
+        '''Connects to the Red Pitaya, configures its SPI device and sets the clear code of the DAC
+        '''
+        rp_s = await scpi_async.open(ip, timeout=timeout, port=int(port))
+        await rp_s.txrx_batch(_init_msgs(spi_dev, spi_speed))
+        dac = cls(rp_s, binary_tx=binary_tx)
+        await dac.write_register(AD5791_REG_CLR, _volt_to_code(default_voltage) & AD5791_MASK_CLR)
+        return dac
+
+    async def close(self):
+        await self.rp_s.txrx_batch(['SPI:RELEASE'])
+        await self.rp_s.close()
+
+    async def _transfer(self, codes, rx=()):
+        rx_buffs = await self.rp_s.txrx_batch(_transfer_msgs(codes, rx, binary=self.binary_tx))
+        return [_parse_read(rx_buff) for rx_buff in rx_buffs]
+
+    async def write_register(self, reg: int, c: int):
+        await self._transfer([AD5791_W | reg | c, AD5791_NOP])
+
+    async def read_register(self, reg: int) -> int:
+        return (await self._transfer([AD5791_R | reg, AD5791_NOP], rx=[1]))[0]
+
+    async def read_registers(self) -> dict:
+        '''Reads DAC, CTL, CLR and SFT registers in a single SPI transaction
+        '''
+        codes = await self._transfer(_READ_REGISTERS_CODES, rx=_READ_REGISTERS_RX)
+        return dict(zip(_READ_REGISTERS_NAMES, codes))
+
+    async def set_voltage(self, v: float):
+        c = _volt_to_code(v)
+        if self.delayed_trig:
+            c_trig = AD5791_NOP
+        else:
+            c_trig = AD5791_W | AD5791_REG_SFT | AD5791_BIT_LDAC
+        await self._transfer([AD5791_W | AD5791_REG_DAC | c, c_trig])
+
+    async def get_voltage(self) -> float:
+        return _code_to_volt(await self.read_register(AD5791_REG_DAC) & AD5791_MASK_DATA)
+
+    async def soft_ldac(self):
+        await self.write_register(AD5791_REG_SFT, AD5791_BIT_LDAC)
@@ -0,0 +1,417 @@
+'''Local emulator of a Red Pitaya SCPI server driving AD5791 DACs over SPI.
+
+Speaks the subset of SCPI used by ad5791.DAC, so that transport and DAC code can be
+benchmarked and regression-tested without hardware:
+
+    with Emulator(latency=200e-6) as emu:
+        dac = DAC(*emu.address)
+        dac.V = 1.0
+        emu.devices['/dev/spidev1.0'].output   # --> ~1.0
+
+or as a stand-alone server:  python -m magstab.dac.ad5791_emulator [port [latency]]
+'''
+
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from .ad5791 import (
+    SPI_SPEED,
+    AD5791_R, AD5791_MASK_RW, AD5791_MASK_REG, AD5791_MASK_DATA,
+    AD5791_REG_DAC, AD5791_REG_CTL, AD5791_REG_CLR, AD5791_REG_SFT,
+    AD5791_BIT_RBUF, AD5791_BIT_OPGND, AD5791_BIT_DACTRI, AD5791_BIT_BIN2SC, AD5791_BIT_SDODIS,
+    AD5791_BIT_LDAC, AD5791_BIT_CLEAR, AD5791_BIT_RESET,
+    AD5791_MASK_CTL, AD5791_MASK_SFT,
+    _code_to_volt,
+)
+
+
+EMULATOR_IDN = 'REDPITAYA,INSTR2020,0,AD5791-EMULATOR'
+DEFAULT_SPI_DEV = '/dev/spidev1.0'
+
+# control register at power-on: output clamped to ground through 6 kOhm and tristated, readback buffer on
+AD5791_CTL_POWER_ON = AD5791_BIT_RBUF | AD5791_BIT_OPGND | AD5791_BIT_DACTRI
+
+
+
+class AD5791Model(object):
+    '''Register model of an AD5791 as seen from its SPI bus.
+
+    A frame is everything clocked in while SYNC (CS) is low. Bits go through a 24-bit shift
+    register whose previous content is clocked out on SDO, and the command is executed when
+    CS rises. A read command loads the requested register into the shift register, so it
+    comes out on SDO during the *next* frame (readback-on-next-frame).
+    '''
+
+    def __init__(self, ldac_low=False):
+        self.ldac_low = ldac_low    # hardware LDAC pin tied low: DAC register follows input register
+        self.reset()
+
+    def reset(self):
+        self.input = 0              # input register, loaded by writes to REG_DAC
+        self.dac = 0                # DAC register, drives the output, loaded by LDAC
+        self.ctl = AD5791_CTL_POWER_ON
+        self.clr = 0
+        self._sr = 0                # 24-bit input shift register
+
+    def frame(self, data: int, nbits=24) -> int:
+        '''Clocks nbits of data in a single frame, executes the command and returns the bits clocked out on SDO
+        '''
+        stream = (self._sr << nbits) | data
+        self._sr = stream & 0xFFFFFF
+        sdo = 0 if self.ctl & AD5791_BIT_SDODIS else stream >> 24
+        if nbits >= 24:
+            self._execute(self._sr)
+        return sdo
+
+    def _execute(self, c: int):
+        reg = c & AD5791_MASK_REG
+        data = c & AD5791_MASK_DATA
+        if c & AD5791_MASK_RW == AD5791_R:
+            self._sr = reg | self._read(reg)
+            return
+        if reg == AD5791_REG_DAC:
+            self.input = data
+            if self.ldac_low:
+                self.dac = self.input
+        elif reg == AD5791_REG_CTL:
+            self.ctl = data & AD5791_MASK_CTL
+        elif reg == AD5791_REG_CLR:
+            self.clr = data
+        elif reg == AD5791_REG_SFT:
+            data &= AD5791_MASK_SFT
+            if data & AD5791_BIT_RESET:
+                self.reset()
+            elif data & AD5791_BIT_CLEAR:
+                self.dac = self.clr
+            elif data & AD5791_BIT_LDAC:
+                self.dac = self.input
+
+    def _read(self, reg: int) -> int:
+        return {
+            AD5791_REG_DAC: self.input,
+            AD5791_REG_CTL: self.ctl,
+            AD5791_REG_CLR: self.clr,
+        }.get(reg, 0)   # software control register is write-only
+
+    @property
+    def output(self):
+        '''Output voltage, 0.0 when clamped to ground, None when tristated
+        '''
+        if self.ctl & AD5791_BIT_OPGND:
+            return 0.0
+        if self.ctl & AD5791_BIT_DACTRI:
+            return None
+        return _code_to_volt(self.dac, is_two_complement=not (self.ctl & AD5791_BIT_BIN2SC))
+
+
+
+class _Message(object):
+    __slots__ = ('tx', 'rx', 'has_rx', 'cs')
+
+    def __init__(self):
+        self.tx = b''
+        self.rx = b''
+        self.has_rx = False
+        self.cs = False
+
+
+
+def _parse_int(token: str) -> int:
+    '''Parses a SCPI numeric value: decimal, #Hxx (hex), #Qxx (octal) or #Bxx (binary)
+    '''
+    token = token.strip()
+    if token[:2].upper() == '#H':
+        return int(token[2:], 16)
+    if token[:2].upper() == '#Q':
+        return int(token[2:], 8)
+    if token[:2].upper() == '#B':
+        return int(token[2:], 2)
+    return int(token)
+
+
+
+class _Session(object):
+    '''State of one client connection: selected SPI device, settings and message list
+    '''
+
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.dev = None
+        self.speed = int(SPI_SPEED)
+        self.mode = 'LIST'
+        self.word = 8
+        self.msgs = None
+
+    def execute(self, line: str, block=None):
+        '''Executes one command, block being its binary data argument if any, returns its reply (str) or None
+        '''
+        emu = self.emulator
+        emu.n_commands += 1
+        header, _, args = line.strip().partition(' ')
+        hdr = header.upper()
+
+        if hdr == '*IDN?':
+            return EMULATOR_IDN
+        if hdr == '*OPC?':
+            return '1'
+        if hdr in ('*CLS', '*RST', '*OPC'):
+            return None
+        if hdr == 'SYST:ERR:COUN?':
+            return str(len(emu.errors))
+        if hdr == 'SYST:ERR:NEXT?':
+            return emu.errors.pop(0) if emu.errors else '0,"No error"'
+
+        if hdr == 'SPI:INIT:DEV':
+            self.dev = args.strip().strip('"')
+            emu.device(self.dev)
+            return None
+        if hdr == 'SPI:INIT':
+            self.dev = DEFAULT_SPI_DEV
+            emu.device(self.dev)
+            return None
+        if hdr == 'SPI:RELEASE':
+            self.dev = None
+            self.msgs = None
+            return None
+
+        if hdr in ('SPI:SET:DEF', 'SPI:SET:GET', 'SPI:SET:SET'):
+            return None
+        if hdr == 'SPI:SET:MODE':
+            self.mode = args.strip()
+            return None
+        if hdr == 'SPI:SET:MODE?':
+            return self.mode
+        if hdr == 'SPI:SET:SPEED':
+            self.speed = int(args)
+            return None
+        if hdr == 'SPI:SET:SPEED?':
+            return str(self.speed)
+        if hdr == 'SPI:SET:WORD':
+            self.word = int(args)
+            return None
+        if hdr == 'SPI:SET:WORD?':
+            return str(self.word)
+
+        if hdr == 'SPI:MSG:CREATE':
+            self.msgs = [_Message() for _ in range(int(args))]
+            return None
+        if hdr == 'SPI:MSG:DEL':
+            self.msgs = None
+            return None
+        if hdr == 'SPI:MSG:SIZE?':
+            return str(len(self.msgs or []))
+        if hdr == 'SPI:PASS':
+            self.spi_pass()
+            return None
+
+        if hdr.startswith('SPI:MSG'):
+            return self._msg(hdr, args, block)
+
+        emu.errors.append('-113,"Undefined header;{0}"'.format(header))
+        return None
+
+    def _msg(self, hdr: str, args: str, block=None):
+        # SPI:MSG<n>:TX<m>[:RX][:CS] <data> | SPI:MSG<n>:RX? | SPI:MSG<n>:TX? | SPI:MSG<n>:CS?
+        fields = hdr.split(':')
+        try:
+            msg = self.msgs[int(fields[1][3:])]
+        except (TypeError, ValueError, IndexError):
+            self.emulator.errors.append('-222,"Data out of range;{0}"'.format(hdr))
+            return None
+        if fields[2] == 'RX?':
+            return '{' + ','.join(str(b) for b in msg.rx) + '}'
+        if fields[2] == 'TX?':
+            return '{' + ','.join(str(b) for b in msg.tx) + '}'
+        if fields[2] == 'CS?':
+            return '1' if msg.cs else '0'
+        if fields[2].startswith('TX'):
+            n = int(fields[2][2:])
+            if block is not None:
+                data = block[:n]
+            elif args.strip():
+                data = bytes(_parse_int(x) & 0xFF for x in args.split(','))[:n]
+            else:
+                data = b''
+            msg.tx = data.ljust(n, b'\x00')
+            msg.has_rx = 'RX' in fields[3:]
+            msg.cs = 'CS' in fields[3:]
+            msg.rx = b'\x00' * n
+            return None
+        self.emulator.errors.append('-113,"Undefined header;{0}"'.format(hdr))
+        return None
+
+    def spi_pass(self):
+        '''Clocks the message list through the selected device, frame by frame
+        '''
+        emu = self.emulator
+        emu.n_passes += 1
+        if self.dev is None or not self.msgs:
+            emu.errors.append('-200,"Execution error;SPI:PASS"')
+            return
+        model = emu.device(self.dev)
+        nbits = 0
+        with emu.lock:
+            pending = []        # messages of the current frame, CS still low
+            for msg in self.msgs:
+                pending.append(msg)
+                if msg.cs:
+                    self._frame(model, pending)
+                    nbits += sum(8*len(m.tx) for m in pending)
+                    pending = []
+            if pending:         # CS released at the end of the list anyway
+                self._frame(model, pending)
+                nbits += sum(8*len(m.tx) for m in pending)
+        if emu.simulate_spi_time and self.speed > 0:
+            time.sleep(nbits / self.speed)
+
+    @staticmethod
+    def _frame(model, msgs):
+        data = b''.join(m.tx for m in msgs)
+        sdo = model.frame(int.from_bytes(data, 'big'), 8*len(data)).to_bytes(len(data), 'big')
+        i = 0
+        for m in msgs:
+            m.rx = sdo[i:i + len(m.tx)]
+            i += len(m.tx)
+
+
+
+_BLOCK_START = re.compile(rb'#[1-9]')
+
+def _split_commands(buff):
+    '''Splits the complete commands at the start of buff, a command ending with CRLF and possibly
+    holding a definite length block (#<n><len><data>, where data may contain CRLF) as its argument.
+    Returns the list of (command text, block data or None) and the number of bytes consumed.
+    '''
+    cmds = []
+    start = 0
+    while True:
+        i = buff.find(b'\r\n', start)
+        m = _BLOCK_START.search(buff, start, len(buff) if i < 0 else i)
+        if m is None:
+            if i < 0:
+                break
+            cmds.append((buff[start:i].decode('utf-8'), None))
+            start = i + 2
+            continue
+        j = m.start()
+        nd = buff[j + 1] - ord('0')
+        if j + 2 + nd > len(buff):
+            break
+        end = j + 2 + nd + int(buff[j + 2:j + 2 + nd])
+        if end + 2 > len(buff):
+            break
+        cmds.append((buff[start:j].decode('utf-8').rstrip(), bytes(buff[j + 2 + nd:end])))
+        start = end + 2     # skip the CRLF following the block
+    return cmds, start
+
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        emu = self.server.emulator
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        session = _Session(emu)
+        buff = bytearray()
+        while True:
+            try:
+                chunk = self.request.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buff += chunk
+            cmds, consumed = _split_commands(buff)
+            del buff[:consumed]
+            replies = []
+            for line, block in cmds:
+                if replies and line.startswith('SPI:PASS'):
+                    self._reply(replies)   # like the real server, replies are not held back by a transfer
+                    replies = []
+                reply = session.execute(line, block)
+                if reply is not None:
+                    replies.append(reply)
+            if replies:
+                self._reply(replies)
+
+    def _reply(self, replies):
+        if self.server.emulator.latency:
+            time.sleep(self.server.emulator.latency)
+        self.request.sendall(''.join(r + '\r\n' for r in replies).encode('utf-8'))
+
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+
+class Emulator(object):
+    '''Threaded TCP server emulating a Red Pitaya SCPI server with AD5791 DACs on its SPI devices.
+
+    latency: seconds added before each batch of replies (one network round trip)
+    simulate_spi_time: if True, SPI:PASS takes as long as the frames at the configured SPI speed
+    '''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, simulate_spi_time=False, ldac_low=False):
+        self.latency = latency
+        self.simulate_spi_time = simulate_spi_time
+        self.ldac_low = ldac_low
+        self.devices = {}       # SPI device name --> AD5791Model, created on SPI:INIT:DEV
+        self.errors = []
+        self.n_commands = 0
+        self.n_passes = 0
+        self.lock = threading.Lock()
+        self._server = _Server((host, port), _Handler, bind_and_activate=True)
+        self._server.emulator = self
+        self._thread = None
+
+    @property
+    def address(self):
+        '''(host, port) to connect to, e.g. DAC(*emulator.address)
+        '''
+        return self._server.server_address[:2]
+
+    def device(self, dev=DEFAULT_SPI_DEV) -> AD5791Model:
+        with self.lock:
+            if dev not in self.devices:
+                self.devices[dev] = AD5791Model(ldac_low=self.ldac_low)
+            return self.devices[dev]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    emulator = Emulator(host='0.0.0.0', port=port, latency=latency)
+    print('AD5791 emulator listening on {0}:{1:d}'.format(*emulator.address))
+    try:
+        emulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,132 @@
+'''Per-device calibration of AD5791 DACs (INL/DNL, gain and offset) with a correction table:
+the measured output voltage of each of the 2^20 codes, stored as a .npy file (8 MB of float64)
+
+    table = make_table(vrefp=10.00124, vrefn=-9.99939, inl=inl_lsb)     # or measured voltages
+    save_table('dac_x.npy', table)
+    dac = DAC(calibration=Calibration('dac_x.npy'))
+    dac.V = 1.0         # highest code whose measured output does not exceed 1.0 V
+
+The table is memory-mapped (read-only) on first use, so processes using the same file share
+the pages of the OS cache instead of each loading the whole table.
+Lookups truncate, like the uncalibrated conversion (ad5791._volt_to_code()): with an ideal table, both
+give the same codes (up to float rounding at the code boundaries). The scalar lookup walks the table
+from the ideal code, a few entries away for a well-behaved DAC (microseconds), the vectorized
+lookup is a binary search (numpy.searchsorted).
+Table index is the offset binary code, i.e. the DAC code with its MSB flipped (two's complement coding).
+'''
+
+import threading
+
+from .ad5791 import (
+    VREFP, VREFN,
+    _volt_to_code, _code_to_volt, _volt_to_code_array,
+)
+
+NBITS = 20
+N_CODES = 1 << NBITS
+_MSB = 1 << (NBITS - 1)
+
+
+
+def make_table(vrefp=VREFP, vrefn=VREFN, inl=None):
+    '''Returns a correction table (float64 array of 2^20 voltages) from the reference voltages of the DAC
+    and, if given, its integral non linearity inl (array of 2^20 values, in LSB, indexed by offset binary code)
+    '''
+    import numpy as np
+    table = vrefn + (vrefp - vrefn) * np.arange(N_CODES, dtype=np.float64) / float(N_CODES - 1)
+    if inl is not None:
+        table += np.asarray(inl, dtype=np.float64) * (vrefp - vrefn) / float(N_CODES - 1)
+    return table
+
+def save_table(path, table):
+    '''Writes a correction table to path (.npy), checking that it has one strictly increasing voltage per code
+    '''
+    import numpy as np
+    table = np.asarray(table, dtype=np.float64)
+    assert table.shape == (N_CODES,)
+    assert np.all(np.diff(table) > 0), 'non monotonic DAC transfer function'
+    np.save(path, table)
+
+
+
+class Calibration(object):
+    '''Voltage/code conversions of one DAC, from its correction table (path to a .npy file),
+    or without table from its reference voltages only (same as ad5791._volt_to_code())
+    '''
+
+    def __init__(self, path=None, vrefp=VREFP, vrefn=VREFN):
+        self.path = path
+        self._vrefp = vrefp
+        self._vrefn = vrefn
+        self._table = None
+        self._lock = threading.Lock()
+
+    @property
+    def table(self):
+        '''Correction table, memory-mapped on first access (None without table)
+        '''
+        if self._table is None and self.path is not None:
+            with self._lock:
+                if self._table is None:
+                    import numpy as np
+                    table = np.load(self.path, mmap_mode='r')
+                    assert table.shape == (N_CODES,)
+                    self._vrefn, self._vrefp = float(table[0]), float(table[-1])
+                    self._table = table
+        return self._table
+
+    @property
+    def vrefp(self) -> float:
+        '''Output voltage of the highest code (VREFP from the table, if any)
+        '''
+        self.table
+        return self._vrefp
+
+    @property
+    def vrefn(self) -> float:
+        self.table
+        return self._vrefn
+
+    def volt_to_code(self, voltage: float) -> int:
+        '''Returns the highest code (two's complement) whose output voltage does not exceed voltage
+        '''
+        table = self.table
+        if table is None:
+            return _volt_to_code(voltage, Vrefp=self._vrefp, Vrefn=self._vrefn)
+        voltage = float(voltage)
+        assert self._vrefn <= voltage <= self._vrefp
+        # start from the ideal code, then walk to the entries bracketing voltage
+        u = int((voltage - self._vrefn) * float(N_CODES - 1) / (self._vrefp - self._vrefn))
+        u = min(u, N_CODES - 2)
+        v_lo = float(table[u])
+        while v_lo > voltage:
+            u -= 1
+            v_lo = float(table[u])
+        v_hi = float(table[u + 1])
+        while v_hi <= voltage and u < N_CODES - 2:
+            u += 1
+            v_lo, v_hi = v_hi, float(table[u + 1])
+        if v_hi <= voltage:     # voltage is the output of the highest code
+            u += 1
+        return u ^ _MSB
+
+    def volt_to_code_array(self, voltages):
+        '''Vectorized volt_to_code(): returns an array of codes (uint32)
+        '''
+        import numpy as np
+        table = self.table
+        if table is None:
+            return _volt_to_code_array(voltages, Vrefp=self._vrefp, Vrefn=self._vrefn)
+        voltages = np.asarray(voltages, dtype=np.float64)
+        assert np.all((self._vrefn <= voltages) & (voltages <= self._vrefp))
+        u = np.clip(np.searchsorted(table, voltages, side='right') - 1, 0, N_CODES - 1)
+        return u.astype(np.uint32) ^ np.uint32(_MSB)
+
+    def code_to_volt(self, code: int) -> float:
+        '''Returns the output voltage of code (two's complement), as measured
+        '''
+        table = self.table
+        if table is None:
+            return _code_to_volt(code, Vrefp=self._vrefp, Vrefn=self._vrefn)
+        assert 0 <= code < N_CODES
+        return float(table[code ^ _MSB])
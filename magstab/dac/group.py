@@ -0,0 +1,119 @@
+'''Synchronous update of several AD5791 DACs (e.g. the three axes of the field), on different
+chip selects of one Red Pitaya or on different boards:
+
+    group = DACGroup([dac_x, dac_y, dac_z])
+    group.V = (1.0, -0.5, 2.0)      # loads the three input registers, then updates the outputs together
+    group.last['skew']              # time spread of the LDAC updates (s)
+
+The input registers are loaded first (DAC write frames, without LDAC), then the LDAC frames are issued
+back to back, each one followed by an *OPC? marker. Per connection, loads and LDACs go out in
+a single write, without waiting for any reply in between. The LDACs are issued in the reverse order
+of the loads, so that DACs on different SPI devices of a board switch device once per phase, and
+a switch to a device already set up by the same DAC keeps its settings (SPI:INIT:DEV only).
+The skew is measured from the arrival times of the markers: an upper bound of the time between
+the first and the last output update. Markers not received within timeout s (the timeout of the
+connections, TIMEOUT if they have none) fail the update, and the connections are reopened.
+'''
+
+import contextlib
+import socket
+import time
+
+from ..external import redpitaya_scpi as scpi
+from .ad5791 import (
+    AD5791_W, AD5791_REG_DAC, AD5791_REG_SFT, AD5791_BIT_LDAC,
+)
+
+
+
+TIMEOUT = 5.0   # s, default wait for the LDAC markers
+
+
+
+class DACGroup(object):
+
+    def __init__(self, dacs, timeout=None):
+        self.dacs = list(dacs)
+        # DACs sharing a connection (same board, see scpi.POOL) are loaded and updated in one write
+        self._conns = []
+        for dac in self.dacs:
+            if all(dac.rp_s is not rp_s for rp_s in self._conns):
+                self._conns.append(dac.rp_s)
+        if timeout is None:
+            timeouts = [rp_s.timeout for rp_s in self._conns if rp_s.timeout is not None]
+            timeout = max(timeouts) if timeouts else TIMEOUT
+        self.timeout = timeout
+        self.last = None    # timing of the last update, see set()
+
+    def __len__(self):
+        return len(self.dacs)
+
+    @property
+    def V(self) -> list:
+        return [dac.V for dac in self.dacs]
+
+    @V.setter
+    def V(self, voltages):
+        self.set(voltages)
+
+    def set(self, voltages) -> dict:
+        '''Sets the output voltages of all the DACs together (one voltage per DAC, in order).
+        Returns (and keeps in self.last) a dict with the arrival times of the LDAC markers, per DAC
+        (s, relative to the first one), the skew (s, spread of these times) and the duration
+        of the whole update (s, from the first write to the last marker).
+        '''
+        voltages = list(voltages)
+        assert len(voltages) == len(self.dacs)
+        codes = [AD5791_W | AD5791_REG_DAC | dac._code(v) for dac, v in zip(self.dacs, voltages)]
+        c_ldac = AD5791_W | AD5791_REG_SFT | AD5791_BIT_LDAC
+
+        with contextlib.ExitStack() as stack:
+            # all the connections are held during the update, in a fixed order against deadlocks
+            for rp_s in sorted(self._conns, key=id):
+                stack.enter_context(rp_s.lock)
+                stack.enter_context(rp_s.operation('DACGroup.V='))
+            for rp_s in self._conns:
+                if not rp_s.is_alive():
+                    rp_s.reconnect()
+            try:
+                t0 = time.perf_counter()
+                for rp_s in self._conns:
+                    for dac, c in zip(self.dacs, codes):
+                        if dac.rp_s is rp_s:
+                            dac._queue_transfer([c])
+                    rp_s.flush(wait=False)
+                pending = {}
+                for rp_s in self._conns:
+                    # in reverse order: the last DAC loaded is still selected, one SPI device switch per phase
+                    pending[rp_s] = [i for i, dac in enumerate(self.dacs) if dac.rp_s is rp_s][::-1]
+                    for i in pending[rp_s]:
+                        self.dacs[i]._queue_transfer([c_ldac])
+                        rp_s.queue_txt('*OPC?')
+                    rp_s.flush(wait=False)
+                # markers are taken as they arrive, from whichever connection, to time them
+                times = [None] * len(self.dacs)
+                deadline = time.perf_counter() + self.timeout
+                while any(pending.values()):
+                    waiting = [rp_s for rp_s, indices in pending.items() if indices]
+                    ready = scpi.select_ready(waiting, deadline - time.perf_counter())
+                    if not ready:
+                        raise socket.timeout('no LDAC marker within {0:g} s'.format(self.timeout))
+                    t = time.perf_counter()
+                    for rp_s in ready:
+                        rp_s.rx_txt()
+                        times[pending[rp_s].pop(0)] = t
+            except OSError as e:
+                print('AD5791 >> group update failed: {!s:s}, reconnecting'.format(e))
+                for rp_s in self._conns:
+                    rp_s.reconnect()
+                raise
+
+        for dac, c in zip(self.dacs, codes):
+            dac._shadow_write(c)
+        t_first = min(times)
+        self.last = {
+            'times': [t - t_first for t in times],
+            'skew': max(times) - t_first,
+            'duration': max(times) - t0,
+        }
+        return self.last
@@ -0,0 +1,153 @@
+'''Slew-limited voltage ramps of an ad5791.DAC, streamed in the background:
+
+    ramp = Ramp(dac, slew=10.0, profile='scurve')   # V/s
+    ramp.to(2.5)        # returns the ramp duration (s) right away, the ramp runs in a thread
+    ramp.to(-1.0)       # retargets mid-flight, from the voltage reached
+    ramp.wait()
+    ramp.close()
+
+Each ramp is precomputed as a sequence of samples (one every 1/rate s) and streamed with DAC.play(),
+in chunks of a few SCPI round trips. Cancelling or retargeting takes effect at the next chunk
+boundary, i.e. within about 2*chunk/rate s. The connection is only held while a chunk is uploaded:
+other DACs of the same board are written during a ramp, after the chunks already uploaded (the same bound).
+'''
+
+import math
+import threading
+
+
+def _linear(u):
+    return u
+
+def _cosine(u):
+    import numpy as np
+    return 0.5 * (1.0 - np.cos(np.pi * u))
+
+def _scurve(u):
+    # smootherstep: zero velocity and acceleration at both ends
+    return u * u * u * (u * (6.0 * u - 15.0) + 10.0)
+
+# profile name --> (shape from 0 to 1 on [0, 1], peak slope of the shape)
+PROFILES = {
+    'linear': (_linear, 1.0),
+    'cosine': (_cosine, math.pi / 2),
+    'scurve': (_scurve, 15.0 / 8),
+}
+
+
+def ramp_samples(v0: float, v1: float, slew: float, profile='linear', rate=1e3):
+    '''Returns the samples (numpy array, at rate samples/s) of a ramp from v0 to v1 (excluded and included)
+    whose slope never exceeds slew (V/s). The last sample is exactly v1.
+    '''
+    import numpy as np
+    shape, peak = PROFILES[profile]
+    assert slew > 0 and rate > 0
+    duration = abs(v1 - v0) * peak / slew
+    n = max(1, int(math.ceil(duration * rate)))
+    u = np.arange(1, n + 1, dtype=np.float64) / n
+    samples = v0 + (v1 - v0) * shape(u)
+    samples[-1] = v1
+    return samples
+
+
+class Ramp(object):
+    '''Background ramp engine of one DAC. Ramps run in a worker thread and are streamed with DAC.play(),
+    the control thread only posts targets with to() and may wait() for them.
+    '''
+
+    def __init__(self, dac, slew: float, profile='cosine', rate=1e3, chunk=32):
+        assert profile in PROFILES
+        self.dac = dac
+        self.slew = slew        # V/s
+        self.profile = profile
+        self.rate = rate        # samples/s
+        self.chunk = chunk      # samples per chunk, sets the cancel/retarget latency
+        self.error = None       # exception raised by the last ramp, re-raised by wait()
+        self.n_ramps = 0
+
+        self._cond = threading.Condition()
+        self._request = None    # (target, slew, profile) waiting for the worker
+        self._busy = False
+        self._closed = False
+        self._v = dac.V         # voltage reached, updated after each ramp
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def V(self) -> float:
+        '''Voltage reached by the last ramp (the DAC output, while no ramp is running)
+        '''
+        return self._v
+
+    @property
+    def running(self) -> bool:
+        with self._cond:
+            return self._busy or self._request is not None
+
+    def to(self, v: float, slew=None, profile=None) -> float:
+        '''Ramps to v (in the background), at slew V/s with profile, defaulting to the engine settings.
+        A running ramp is stopped at its next chunk boundary, and the new one starts from there.
+        Returns the duration of the ramp from the current voltage (s), for information.
+        '''
+        slew = self.slew if slew is None else slew
+        profile = self.profile if profile is None else profile
+        assert profile in PROFILES and slew > 0
+        with self._cond:
+            assert not self._closed
+            self._request = (float(v), slew, profile)
+            self._cond.notify_all()
+            return abs(v - self._v) * PROFILES[profile][1] / slew
+
+    def cancel(self):
+        '''Stops the ramp at its next chunk boundary, the output holds the voltage reached
+        '''
+        with self._cond:
+            self._request = ('cancel', None, None)
+            self._cond.notify_all()
+
+    def wait(self, timeout=None) -> bool:
+        '''Waits for the ramps to end, returns False on timeout. Re-raises an error of the last ramp.
+        '''
+        with self._cond:
+            done = self._cond.wait_for(lambda: not self._busy and self._request is None, timeout)
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+        return done
+
+    def close(self):
+        '''Cancels any ramp and stops the worker thread
+        '''
+        with self._cond:
+            self._closed = True
+            self._request = None
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _stop(self) -> bool:
+        # DAC.play() stop hook: a new request (retarget, cancel or close) ends the current ramp
+        return self._request is not None or self._closed
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._request is not None or self._closed)
+                if self._closed:
+                    return
+                target, slew, profile = self._request
+                self._request = None
+                self._busy = True
+            try:
+                if target != 'cancel' and target != self._v:
+                    samples = ramp_samples(self._v, target, slew, profile, self.rate)
+                    played = self.dac.play(samples, self.rate, chunk=self.chunk, stop=self._stop)['samples']
+                    if played:
+                        self._v = float(samples[played - 1])
+                    self.n_ramps += 1
+            except Exception as e:
+                print('AD5791 >> ramp to {0} V failed: {1!s:s}'.format(target, e))
+                self.error = e
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
@@ -0,0 +1,120 @@
+'''Background writer of DAC setpoints, latest value wins:
+
+    writer = Writer(dac)
+    writer.post(v)          # never blocks on network I/O
+    ...
+    writer.stats()          # delivered rate, coalesced setpoints, age of the writes
+    writer.close()
+
+A control loop posting setpoints faster than the link can carry them does not queue stale values:
+a setpoint posted while the previous one is still waiting replaces it, so each write sends the newest
+value. The age of a write is the time from its post() to the end of its DAC.V transaction.
+'''
+
+import threading
+import time
+
+from ..external.redpitaya_scpi import latency_histogram
+
+
+
+class Writer(object):
+
+    def __init__(self, dac):
+        self.dac = dac
+        self.error = None       # last exception raised by a write
+        self._cond = threading.Condition()
+        self._pending = None    # (voltage, time.perf_counter() of post) waiting for the writer thread
+        self._busy = False
+        self._closed = False
+        self._v = None          # last voltage written
+        self.reset_stats()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def V(self):
+        '''Last voltage written (None before the first write)
+        '''
+        return self._v
+
+    def post(self, v: float):
+        '''Posts setpoint v, to be written as soon as the writer is free; replaces a setpoint still waiting
+        '''
+        t = time.perf_counter()
+        with self._cond:
+            assert not self._closed
+            if self._pending is not None:
+                self._n_coalesced += 1
+            self._pending = (v, t)
+            self._n_posted += 1
+            self._cond.notify_all()
+
+    def flush(self, timeout=None) -> bool:
+        '''Waits until the last setpoint posted is written, returns False on timeout
+        '''
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending is None and not self._busy, timeout)
+
+    def close(self):
+        '''Writes the last setpoint posted, then stops the writer thread
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def reset_stats(self):
+        with self._cond:
+            self._t_start = time.perf_counter()
+            self._n_posted = 0
+            self._n_written = 0
+            self._n_coalesced = 0
+            self._n_errors = 0
+            self._ages = latency_histogram()
+            self._last_age = None
+
+    def stats(self) -> dict:
+        '''Returns the numbers of setpoints posted, written, coalesced (replaced before being written) and
+        failed, the delivered rate (writes/s since the last reset_stats()) and the age of the writes (s):
+        last one, and mean, p50, p99 and max
+        '''
+        with self._cond:
+            elapsed = time.perf_counter() - self._t_start
+            out = {
+                'posted': self._n_posted,
+                'written': self._n_written,
+                'coalesced': self._n_coalesced,
+                'errors': self._n_errors,
+                'rate': self._n_written / elapsed if elapsed > 0 else 0.0,
+                'age': self._last_age,
+            }
+            out.update({'age_' + k: v for k, v in self._ages.report().items()})
+            return out
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None or self._closed)
+                if self._pending is None:
+                    return
+                (v, t_post), self._pending = self._pending, None
+                self._busy = True
+            try:
+                self.dac.V = v
+            except Exception as e:
+                print('AD5791 >> write of {0} V failed: {1!s:s}'.format(v, e))
+                with self._cond:
+                    self.error = e
+                    self._n_errors += 1
+            else:
+                age = time.perf_counter() - t_post
+                with self._cond:
+                    self._v = v
+                    self._n_written += 1
+                    self._ages.add(age)
+                    self._last_age = age
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
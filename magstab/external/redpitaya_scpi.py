@@ -1,6 +1,13 @@
 """SCPI access to Red Pitaya."""
 
+import collections
+import contextlib
+import math
+import select
 import socket
+import struct
+import threading
+import time
 
 __author__ = "Luka Golinar, Iztok Jeras"
 __copyright__ = "Copyright 2015, Red Pitaya"
@@ -9,22 +16,33 @@ class scpi (object):
     """SCPI class used to access Red Pitaya over an IP network."""
     delimiter = '\r\n'
 
-    def __init__(self, host, timeout=None, port=5000):
+    def __init__(self, host, timeout=None, port=5000, record=None):
         """Initialize object and open IP connection.
         Host IP should be a string in parentheses, like '192.168.1.100'.
+        If the connection fails, it is retried (see reconnect()) on first use.
+        With record (path of a log file), every command and reply is appended to the log with
+        its time.monotonic() timestamp, see read_log() and redpitaya_scpi_replay. The log file is
+        closed with the connection, and appended to again by a reconnect.
         """
         self.host    = host
         self.port    = port
         self.timeout = timeout
 
-        try:
-            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            if timeout is not None:
-                self._socket.settimeout(timeout)
+        self.lock    = threading.RLock() # held by users sharing this connection across threads
+        self.session = None              # owner of the server-side session state (SPI setup), None after (re)connect
+        self.prepared = None             # owner of the SPI message list kept allocated on the server, None after (re)connect
+        self.spi_setup = {}              # SPI device --> owner of the settings last set up on it, empty after (re)connect
 
-            self._socket.connect((host, port))
+        self._socket = None
+        self._queue  = []
+        self._rx_buff = bytearray() # received bytes not consumed yet, they can hold several replies
+        self._rx_scan = 0           # offset in _rx_buff from which to look for the next delimiter
+        self._orphans = 0           # replies in flight left by a user who released the connection, see leave_replies()
+        self._stats  = None         # traffic statistics, see enable_stats()
+        self._recorder = _recorder(record) if record is not None else None
 
+        try:
+            self.connect()
         except socket.error as e:
             print('SCPI >> connect({!s:s}:{:d}) failed: {!s:s}'.format(host, port, e))
 
@@ -32,53 +50,328 @@ class scpi (object):
         if self._socket is not None:
             self._socket.close()
         self._socket = None
+        if getattr(self, '_recorder', None) is not None:
+            self._recorder.close()      # reopened by the next connection, if any
 
     def close(self):
-        """Close IP connection."""
+        """Close IP connection. The session is dropped too: nothing is sent again before a (re)connect."""
         self.__del__()
+        self.session = None
+        self.prepared = None
+
+    def connect(self):
+        """Open IP connection, dropping any previous one together with its pending data and session."""
+        self.close()
+        self._queue = []
+        self._rx_buff = bytearray()
+        self._rx_scan = 0
+        self._orphans = 0
+        self.session = None
+        self.prepared = None
+        self.spi_setup = {}
+        if self._stats is not None:
+            self._stats.pending.clear()
+        self._socket = self._open()
+
+    def _open(self):
+        """Return a new socket connected to the server."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # commands are small, do not wait to coalesce them
+            if self.timeout is not None:
+                sock.settimeout(self.timeout)
+            sock.connect((self.host, self.port))
+        except socket.error:
+            sock.close()
+            raise
+        if self._recorder is not None:
+            self._recorder.write(_LOG_CONNECT, '{0}:{1:d}'.format(self.host, self.port).encode('utf-8'))
+            sock = _recording_socket(sock, self._recorder)
+        return sock
+
+    def reconnect(self, retries=10, backoff=1e-3, backoff_max=0.5):
+        """Reopen IP connection, retrying with exponential backoff.
+        The first attempt is immediate, the next ones wait backoff, 2*backoff, ... up to backoff_max seconds.
+        Raise the last socket error if all attempts fail.
+        """
+        delay = 0
+        for attempt in range(retries + 1):
+            time.sleep(delay)
+            try:
+                self.connect()
+            except socket.error as e:
+                print('SCPI >> reconnect({!s:s}:{:d}) failed: {!s:s}'.format(self.host, self.port, e))
+                if attempt == retries:
+                    raise
+                delay = min(backoff_max, max(backoff, 2*delay))
+            else:
+                return
+
+    def is_alive(self):
+        """Health check: return False if the connection is closed or was dropped by the server."""
+        if self._socket is None:
+            return False
+        try:
+            readable, _, _ = select.select([self._socket], [], [], 0)
+            if readable:
+                # readable without pending data means the server closed the connection
+                return len(self._socket.recv(1, socket.MSG_PEEK)) > 0
+        except (socket.error, ValueError):
+            return False
+        return True
+
+    def _rx_fill(self, chunksize = 4096):
+        """Receive one chunk from the socket and append it to the receive buffer."""
+        chunk = self._socket.recv(chunksize) # Receive chunk size of 2^n preferably
+        if not chunk:
+            raise ConnectionError('SCPI >> connection closed by {!s:s}:{:d}'.format(self.host, self.port))
+        if self._stats is not None:
+            self._stats.recv(len(chunk))
+        self._rx_buff += chunk
+
+    def _rx_next(self):
+        """Pop the next complete reply from the receive buffer, or return None if there is none yet.
+        The buffer is only scanned from where the previous search stopped.
+        """
+        delimiter = self.delimiter.encode('utf-8')
+        i = self._rx_buff.find(delimiter, self._rx_scan)
+        if i < 0:
+            self._rx_scan = max(0, len(self._rx_buff) - len(delimiter) + 1)
+            return None
+        msg = self._rx_buff[:i].decode('utf-8')
+        del self._rx_buff[:i + len(delimiter)]
+        self._rx_scan = 0
+        if self._stats is not None:
+            self._stats.received(i + len(delimiter))
+        return msg
+
+    def leave_replies(self, n):
+        """Release n replies still in flight, e.g. before giving the connection (lock) to other users:
+        the next receive drops them first, unless the same user gets them back with take_replies().
+        """
+        self._orphans += n
+
+    def take_replies(self, n):
+        """Get back up to n replies left with leave_replies() (the last ones left), and return how many
+        are still in flight: the others were dropped by a receive in between, their commands are done.
+        """
+        n = min(n, self._orphans)
+        self._orphans -= n
+        return n
+
+    def _rx_drop(self, chunksize = 4096):
+        """Receive and drop the replies left in flight by leave_replies()."""
+        delimiter = self.delimiter.encode('utf-8')
+        while self._orphans:
+            if self._rx_buff.find(delimiter, self._rx_scan) < 0:
+                self._rx_scan = max(0, len(self._rx_buff) - len(delimiter) + 1)
+                self._rx_fill(chunksize)
+                continue
+            self._orphans -= 1
+            self._rx_next()
 
     def rx_txt(self, chunksize = 4096):
         """Receive text string and return it after removing the delimiter."""
-        msg = ''
+        self._rx_drop(chunksize)
         while 1:
-            chunk = self._socket.recv(chunksize).decode('utf-8') # Receive chunk size of 2^n preferably
-            msg += chunk
-            if (len(msg) and msg[-2:] == self.delimiter):
-                break
-        return msg[:-2]
-
-    def rx_arb(self):
-        numOfBytes = 0
-        """ Recieve binary data from scpi server"""
-        str=b''
-        while (len(str) != 1):
-            str = (self._socket.recv(1))
-        if not (str == b'#'):
+            msg = self._rx_next()
+            if msg is not None:
+                return msg
+            self._rx_fill(chunksize)
+
+    def rx_iter(self, n=None, chunksize = 4096):
+        """Generator yielding replies (without delimiter) as soon as they are complete.
+        Bytes following a reply are kept for the next one, so replies sharing a single recv()
+        are all returned. Stop after n replies, or never if n is None.
+        """
+        self._rx_drop(chunksize)
+        count = 0
+        while n is None or count < n:
+            msg = self._rx_next()
+            if msg is None:
+                self._rx_fill(chunksize)
+                continue
+            count += 1
+            yield msg
+
+    def _recv_into(self, view):
+        """Fill a writable memoryview completely, first from the receive buffer then from the socket."""
+        if self._rx_buff:
+            n = min(len(view), len(self._rx_buff))
+            view[:n] = self._rx_buff[:n]
+            del self._rx_buff[:n]
+            self._rx_scan = 0
+            view = view[n:]
+        while len(view):
+            n = self._socket.recv_into(view)
+            if n == 0:
+                raise ConnectionError('SCPI >> connection closed by {!s:s}:{:d}'.format(self.host, self.port))
+            if self._stats is not None:
+                self._stats.recv(n)
+            view = view[n:]
+
+    def rx_arb(self, out=None):
+        """Receive binary data (IEEE 488.2 definite length block) from scpi server.
+        The payload is received in place, into out if given (bytearray or writable memoryview
+        large enough for the block) or else into a new bytearray.
+        Return a buffer holding the payload, or False if the reply is not a binary block.
+        """
+        self._rx_drop()
+        header = bytearray(2)
+        self._recv_into(memoryview(header))
+        if not (header[0:1] == b'#'):
             return False
-        str=b''
-        while (len(str) != 1):
-            str = (self._socket.recv(1))
-        numOfNumBytes = int(str)
+        numOfNumBytes = int(header[1:2])
         if not (numOfNumBytes > 0):
             return False
-        str=b''
-        while (len(str) != numOfNumBytes):
-            str += (self._socket.recv(1))
-        numOfBytes = int(str)
-        str=b''
-        while (len(str) != numOfBytes):
-            str += (self._socket.recv(4096))
-        return str
+        length = bytearray(numOfNumBytes)
+        self._recv_into(memoryview(length))
+        numOfBytes = int(length)
+        if out is None:
+            out = bytearray(numOfBytes)
+        view = memoryview(out).cast('B')[:numOfBytes]
+        if len(view) != numOfBytes:
+            raise ValueError('SCPI >> rx_arb() buffer too small for {:d} bytes'.format(numOfBytes))
+        self._recv_into(view)
+        # the block is followed by the delimiter, as any reply
+        delimiter = self.delimiter.encode('utf-8')
+        tail = bytearray(len(delimiter))
+        self._recv_into(memoryview(tail))
+        if tail != delimiter:
+            raise ConnectionError('SCPI >> rx_arb() block not followed by the delimiter: {!r:s}'.format(bytes(tail)))
+        if self._stats is not None:
+            self._stats.received(2 + numOfNumBytes + numOfBytes + len(delimiter))
+        return out if len(out) == numOfBytes else view
+
+    def rx_arb_array(self, dtype='>f4', out=None):
+        """Receive binary data from scpi server and return it as a NumPy array.
+        The array is a view on the receive buffer, no copy is made.
+        Default dtype is big-endian float32, used by the server for ACQ:DATA in BIN format.
+        """
+        import numpy as np
+        buff = self.rx_arb(out=out)
+        if buff is False:
+            return False
+        return np.frombuffer(buff, dtype=dtype)
 
     def tx_txt(self, msg):
         """Send text string ending and append delimiter."""
-        return self._socket.sendall((msg + self.delimiter).encode('utf-8')) # was send(().encode('utf-8'))
+        self._tx([(msg, (msg + self.delimiter).encode('utf-8'))]) # was send(().encode('utf-8'))
 
     def txrx_txt(self, msg):
         """Send/receive text string."""
         self.tx_txt(msg)
         return self.rx_txt()
 
+    @staticmethod
+    def arb_block(data) -> bytes:
+        """Return data (bytes-like) framed as an IEEE 488.2 definite length block: #<n><len><data>."""
+        length = str(len(data)).encode('ascii')
+        return b'#' + str(len(length)).encode('ascii') + length + bytes(data)
+
+    def _arb_cmd(self, msg, data) -> bytes:
+        return (msg + ' ').encode('utf-8') + self.arb_block(data) + self.delimiter.encode('utf-8')
+
+    def tx_arb(self, msg, data):
+        """Send command msg with binary data (bytes-like) as its argument, in a definite length block."""
+        self._tx([(msg, self._arb_cmd(msg, data))])
+
+    def _tx(self, cmds):
+        """Send a list of (msg, encoded command) in a single write."""
+        if self._socket is None:
+            self.reconnect()
+        if self._stats is None:
+            self._socket.sendall(b''.join([cmd for _, cmd in cmds]))
+            return
+        t0 = time.perf_counter()
+        self._socket.sendall(b''.join([cmd for _, cmd in cmds]))
+        self._stats.sent(cmds, t0, time.perf_counter())
+
+# Pipelined commands
+
+    @staticmethod
+    def is_query(msg):
+        """Return True if the command header ends with '?', i.e. the server will reply."""
+        return msg.split(' ', 1)[0].endswith('?')
+
+    def queue_txt(self, msg):
+        """Queue text string, it is sent with the next flush()."""
+        self._queue.append((msg, (msg + self.delimiter).encode('utf-8')))
+
+    def queue_arb(self, msg, data):
+        """Queue command msg with binary data as its argument (see tx_arb()), it is sent with the next flush()."""
+        self._queue.append((msg, self._arb_cmd(msg, data)))
+
+    def flush(self, wait=True):
+        """Send all queued commands in a single write.
+        Return the list of replies to the queued queries, in the order they were queued.
+        With wait=False, return the number of replies instead, to be received later with rx_txt()
+        or rx_txt_n(): more commands can be sent meanwhile, while the server processes these ones.
+        """
+        cmds = self._queue
+        self._queue = []
+        n = sum(1 for msg, _ in cmds if self.is_query(msg))
+        if cmds:
+            self._tx(cmds)
+        if not wait:
+            return n
+        return self.rx_txt_n(n) if n else []
+
+    def txrx_batch(self, msgs):
+        """Send a list of commands in a single write and return the replies to its queries.
+        Each item is a text string, or a (msg, data) tuple for a command with binary data (see tx_arb()).
+        """
+        for msg in msgs:
+            if isinstance(msg, tuple):
+                self.queue_arb(*msg)
+            else:
+                self.queue_txt(msg)
+        return self.flush()
+
+    def rx_txt_n(self, n, chunksize = 4096):
+        """Receive n replies and return them as a list, without their delimiters."""
+        return list(self.rx_iter(n, chunksize))
+
+    def rx_ready(self):
+        """Return True if reply data was received and not consumed yet, without blocking."""
+        if self._rx_buff:
+            return True
+        if self._socket is None:
+            return False
+        readable, _, _ = select.select([self._socket], [], [], 0)
+        return bool(readable)
+
+# Traffic statistics
+
+    def enable_stats(self, enabled=True):
+        """Start (or stop) recording per-command traffic and latency statistics, see stats()."""
+        if not enabled:
+            self._stats = None
+        elif self._stats is None:
+            self._stats = _stats()
+
+    def reset_stats(self):
+        """Clear recorded statistics, if enabled."""
+        if self._stats is not None:
+            self._stats = _stats()
+
+    def stats(self):
+        """Return recorded statistics as a dict (empty if disabled):
+        totals (writes, recvs, round_trips, bytes_tx, bytes_rx), 'commands' per command header
+        (count, bytes, latency percentiles in seconds) and 'operations' per name given to operation().
+        The latency of a query runs from the write holding it to its reply, the latency of a
+        command from the start to the end of the write holding it.
+        """
+        return {} if self._stats is None else self._stats.report()
+
+    def operation(self, name):
+        """Context manager accounting all traffic inside it as one high-level operation called name.
+        Nested operations are accounted in the outermost one only. No-op when statistics are disabled.
+        """
+        if self._stats is None:
+            return _NO_OPERATION
+        return self._stats.operation(name)
+
 # IEEE Mandated Commands
 
     def cls(self):
@@ -134,3 +427,310 @@ class scpi (object):
     def err_c(self):
         """Error next."""
         return rp.txrx_txt('SYST:ERR:NEXT?')
+
+
+_NO_OPERATION = contextlib.nullcontext()
+
+
+class latency_histogram (object):
+    """Latency histogram with logarithmic bins, BINS_PER_DECADE per decade from T_MIN to 100 s:
+    add() durations (s), report() their mean, median, 99th percentile and maximum.
+    """
+    BINS_PER_DECADE = 20
+    T_MIN = 1e-7
+    N_BINS = 9 * BINS_PER_DECADE
+
+    def __init__(self):
+        self.counts = [0] * self.N_BINS
+        self.n      = 0
+        self.total  = 0.0
+        self.max    = 0.0
+
+    def add(self, dt):
+        i = int(math.log10(dt / self.T_MIN) * self.BINS_PER_DECADE) if dt > self.T_MIN else 0
+        self.counts[min(i, self.N_BINS - 1)] += 1
+        self.n += 1
+        self.total += dt
+        self.max = max(self.max, dt)
+
+    def percentile(self, q):
+        """Upper edge of the bin holding the q-th percentile, i.e. within one bin width (12 %)."""
+        if self.n == 0:
+            return None
+        target = q / 100 * self.n
+        count = 0
+        for i, c in enumerate(self.counts):
+            count += c
+            if count >= target and c:
+                return min(self.max, self.T_MIN * 10 ** ((i + 1) / self.BINS_PER_DECADE))
+        return self.max
+
+    def report(self):
+        return {
+            'mean': self.total / self.n if self.n else None,
+            'p50':  self.percentile(50),
+            'p99':  self.percentile(99),
+            'max':  self.max if self.n else None,
+        }
+
+
+class _counters (object):
+    """Traffic counters of one command header or of one operation."""
+
+    def __init__(self):
+        self.count       = 0
+        self.commands    = 0
+        self.writes      = 0
+        self.round_trips = 0
+        self.bytes_tx    = 0
+        self.bytes_rx    = 0
+        self.latency     = latency_histogram()
+
+
+class _stats (object):
+    """Traffic statistics of a scpi connection, see scpi.stats()."""
+
+    def __init__(self):
+        self.total     = _counters()
+        self.recvs     = 0
+        self.commands  = collections.defaultdict(_counters)
+        self.ops       = collections.defaultdict(_counters)
+        self.pending   = collections.deque() # (counters, op, time sent) of queries waiting for their reply
+        self._local    = threading.local()
+
+    @staticmethod
+    def header(msg):
+        return msg.split(' ', 1)[0]
+
+    def sent(self, cmds, t0, t1):
+        """Account one write holding cmds, a list of (msg, encoded command), which started at t0 and ended at t1."""
+        op = getattr(self._local, 'op', None)
+        total = self.total
+        queries = 0
+        nbytes = 0
+        for msg, cmd in cmds:
+            header = self.header(msg)
+            c = self.commands[header]
+            n = len(cmd)
+            c.count += 1
+            c.bytes_tx += n
+            nbytes += n
+            if header.endswith('?'):
+                queries += 1
+                self.pending.append((c, op, t0))
+            else:
+                c.latency.add(t1 - t0)
+        for c in (total, op) if op is not None else (total,):
+            c.commands += len(cmds)
+            c.writes += 1
+            c.round_trips += 1 if queries else 0
+            c.bytes_tx += nbytes
+
+    def received(self, nbytes):
+        """Account a complete reply of nbytes, matched to the oldest query waiting for it."""
+        t = time.perf_counter()
+        self.total.bytes_rx += nbytes
+        if not self.pending:
+            return
+        c, op, t0 = self.pending.popleft()
+        c.bytes_rx += nbytes
+        c.latency.add(t - t0)
+        if op is not None:
+            op.bytes_rx += nbytes
+
+    def recv(self, nbytes):
+        self.recvs += 1
+
+    @contextlib.contextmanager
+    def operation(self, name):
+        if getattr(self._local, 'op', None) is not None:
+            yield
+            return
+        op = self.ops[name]
+        self._local.op = op
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            op.latency.add(time.perf_counter() - t0)
+            op.count += 1
+            self._local.op = None
+
+    def report(self):
+        t = self.total
+        return {
+            'writes':      t.writes,
+            'recvs':       self.recvs,
+            'round_trips': t.round_trips,
+            'bytes_tx':    t.bytes_tx,
+            'bytes_rx':    t.bytes_rx,
+            'commands': {
+                header: dict(count=c.count, bytes_tx=c.bytes_tx, bytes_rx=c.bytes_rx, **c.latency.report())
+                for header, c in self.commands.items()
+            },
+            'operations': {
+                name: dict(count=c.count, commands=c.commands, writes=c.writes, round_trips=c.round_trips,
+                           round_trips_per_op=c.round_trips / c.count if c.count else None,
+                           bytes_tx=c.bytes_tx, bytes_rx=c.bytes_rx, **c.latency.report())
+                for name, c in self.ops.items()
+            },
+        }
+
+
+# Session logs: a header, then one record per connection, command write or reply chunk received, as
+# <kind (1 byte)><time.monotonic() (float64)><length (uint32)><data>, little-endian, appended as they happen
+
+LOG_MAGIC = b'RPSCPI\x00\x01'
+_LOG_RECORD = struct.Struct('<cdI')
+_LOG_CONNECT = b'C'     # data: host:port
+_LOG_TX = b'T'          # data: bytes written
+_LOG_RX = b'R'          # data: bytes received (empty when the server closed the connection)
+
+
+class _recorder (object):
+    """Append-only writer of a session log, the file is reopened by a write after close()."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(LOG_MAGIC)
+
+    def write(self, kind, data, t=None):
+        if self._file.closed:
+            self._open()
+        self._file.write(_LOG_RECORD.pack(kind, time.monotonic() if t is None else t, len(data)))
+        self._file.write(data)
+
+    def flush(self):
+        if not self._file.closed:
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class _recording_socket (object):
+    """Socket wrapper logging the data written and received (peeked data is not logged)."""
+
+    def __init__(self, sock, recorder):
+        self._sock = sock
+        self._recorder = recorder
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def sendall(self, data):
+        self._recorder.write(_LOG_TX, data)
+        self._sock.sendall(data)
+
+    def recv(self, bufsize, flags=0):
+        data = self._sock.recv(bufsize, flags)
+        if not flags & socket.MSG_PEEK:
+            self._recorder.write(_LOG_RX, data)
+        return data
+
+    def recv_into(self, view):
+        n = self._sock.recv_into(view)
+        self._recorder.write(_LOG_RX, bytes(view[:n]))
+        return n
+
+    def close(self):
+        self._sock.close()
+        self._recorder.flush()
+
+
+def read_log(path):
+    """Generator yielding the records (kind, time.monotonic() timestamp, data) of a session log,
+    kind being 'connect' (data: b'host:port'), 'tx' or 'rx'.
+    """
+    kinds = {_LOG_CONNECT: 'connect', _LOG_TX: 'tx', _LOG_RX: 'rx'}
+    with open(path, 'rb') as f:
+        if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError('SCPI >> {!s:s} is not a session log'.format(path))
+        while True:
+            header = f.read(_LOG_RECORD.size)
+            if len(header) < _LOG_RECORD.size:
+                return      # end of log, or record cut by a crash
+            kind, t, length = _LOG_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield kinds[kind], t, data
+
+
+def select_ready(conns, timeout=None):
+    """Wait until reply data is ready on any of conns (scpi connections), at most timeout seconds
+    (None: no limit). Return the list of the connections ready, empty on timeout.
+    """
+    deadline = None if timeout is None else time.perf_counter() + timeout
+    while True:
+        ready = [conn for conn in conns if conn.rx_ready()]
+        remaining = None if deadline is None else deadline - time.perf_counter()
+        if ready or (remaining is not None and remaining <= 0):
+            return ready
+        sockets = [conn._socket for conn in conns if conn._socket is not None]
+        if all(hasattr(sock, 'fileno') for sock in sockets):
+            select.select(sockets, [], [], remaining)
+        else:
+            time.sleep(1e-4 if remaining is None else min(1e-4, remaining))  # sockets without a file (replay)
+
+
+class scpi_pool (object):
+    """Pool of scpi connections shared by all users of the same host and port.
+    Connections are health-checked when handed out, and reopened (see scpi.reconnect()) if dropped.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._conns  = {}
+        self._refs   = {}
+        self._lock   = threading.Lock()
+
+    def get(self, host, port=5000):
+        """Return the shared connection to host:port, opening or reopening it if needed."""
+        key = (host, int(port))
+        with self._lock:
+            conn = self._conns.get(key)
+            if conn is None:
+                conn = scpi(host, timeout=self.timeout, port=int(port))
+                self._conns[key] = conn
+                self._refs[key] = 0
+            self._refs[key] += 1
+        # reconnected under the lock of this connection only: a dead host does not stall the other ones
+        try:
+            with conn.lock:
+                if not conn.is_alive():
+                    conn.reconnect()
+        except Exception:
+            self.release(conn)
+            raise
+        return conn
+
+    def release(self, conn):
+        """Give back a connection obtained with get(), it is closed when its last user releases it."""
+        key = (conn.host, int(conn.port))
+        with self._lock:
+            if self._conns.get(key) is not conn:
+                return
+            self._refs[key] -= 1
+            if self._refs[key] <= 0:
+                del self._conns[key]
+                del self._refs[key]
+                conn.close()
+
+    def close(self):
+        """Close all connections of the pool."""
+        with self._lock:
+            for conn in self._conns.values():
+                conn.close()
+            self._conns.clear()
+            self._refs.clear()
+
+
+# default pool, used by ad5791.DAC
+POOL = scpi_pool()
@@ -0,0 +1,113 @@
+"""Asyncio SCPI access to Red Pitaya."""
+
+import asyncio
+
+from .redpitaya_scpi import scpi
+
+
+class scpi_async (object):
+    """Asyncio counterpart of the scpi class.
+    Several connections (i.e. several Red Pitayas) can be driven concurrently from one event loop.
+    Open connections with: rp_s = await scpi_async.open('192.168.1.100')
+    """
+    delimiter = scpi.delimiter
+    is_query = staticmethod(scpi.is_query)
+
+    def __init__(self, host, reader, writer, timeout=None, port=5000):
+        self.host    = host
+        self.port    = port
+        self.timeout = timeout
+
+        self._reader = reader
+        self._writer = writer
+        self._lock   = asyncio.Lock()   # one batch in flight at a time, so replies match their queries
+
+    @classmethod
+    async def open(cls, host, timeout=None, port=5000):
+        """Open IP connection and return a new scpi_async object."""
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            print('SCPI >> connect({!s:s}:{:d}) failed: {!s:s}'.format(host, port, e))
+            raise
+        return cls(host, reader, writer, timeout=timeout, port=port)
+
+    async def close(self):
+        """Close IP connection."""
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+        self._writer = None
+
+    async def _rx(self):
+        msg = await asyncio.wait_for(self._reader.readuntil(self.delimiter.encode('utf-8')), self.timeout)
+        return msg[:-len(self.delimiter)].decode('utf-8')
+
+    async def rx_txt(self):
+        """Receive text string and return it after removing the delimiter."""
+        async with self._lock:
+            return await self._rx()
+
+    async def rx_arb(self):
+        """Receive binary data (IEEE 488.2 definite length block) from scpi server.
+        Return the payload as bytes, or False if the reply is not a binary block.
+        """
+        async with self._lock:
+            return await asyncio.wait_for(self._rx_arb(), self.timeout)
+
+    async def _rx_arb(self):
+        header = await self._reader.readexactly(2)
+        if not (header[0:1] == b'#'):
+            return False
+        numOfNumBytes = int(header[1:2])
+        if not (numOfNumBytes > 0):
+            return False
+        numOfBytes = int(await self._reader.readexactly(numOfNumBytes))
+        data = await self._reader.readexactly(numOfBytes)
+        # the block is followed by the delimiter, as any reply
+        tail = await self._reader.readexactly(len(self.delimiter))
+        if tail != self.delimiter.encode('utf-8'):
+            raise ConnectionError('SCPI >> rx_arb() block not followed by the delimiter: {!r:s}'.format(tail))
+        return data
+
+    async def tx_txt(self, msg):
+        """Send text string ending and append delimiter."""
+        async with self._lock:
+            self._writer.write((msg + self.delimiter).encode('utf-8'))
+            await self._writer.drain()
+
+    async def txrx_txt(self, msg):
+        """Send/receive text string."""
+        async with self._lock:
+            self._writer.write((msg + self.delimiter).encode('utf-8'))
+            await self._writer.drain()
+            return await self._rx()
+
+    def _cmd(self, msg) -> bytes:
+        if isinstance(msg, tuple):
+            msg, data = msg
+            return (msg + ' ').encode('utf-8') + scpi.arb_block(data) + self.delimiter.encode('utf-8')
+        return (msg + self.delimiter).encode('utf-8')
+
+    async def tx_arb(self, msg, data):
+        """Send command msg with binary data (bytes-like) as its argument, in a definite length block."""
+        async with self._lock:
+            self._writer.write(self._cmd((msg, data)))
+            await self._writer.drain()
+
+    async def txrx_batch(self, msgs):
+        """Send a list of commands in a single write and return the replies to its queries, in order.
+        Each item is a text string, or a (msg, data) tuple for a command with binary data.
+        """
+        async with self._lock:
+            self._writer.write(b''.join([self._cmd(msg) for msg in msgs]))
+            await self._writer.drain()
+            return [await self._rx() for msg in msgs if not isinstance(msg, tuple) and self.is_query(msg)]
+
+    async def idn_q(self):
+        """Identification Query"""
+        return await self.txrx_txt('*IDN?')
+
+    async def opc_q(self):
+        """Operation Complete Query"""
+        return await self.txrx_txt('*OPC?')
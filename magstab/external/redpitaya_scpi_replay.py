@@ -0,0 +1,133 @@
+"""Replay of recorded SCPI sessions, without hardware.
+
+Record a session once, against the real Red Pitaya:
+
+    rp_s = scpi('172.16.10.75', record='session.log')
+    dac = DAC(connection=rp_s)
+    ...
+
+then replay it as many times as needed, e.g. to profile the client code:
+
+    dac = DAC(connection=scpi_replay('session.log'))                  # as fast as possible
+    dac = DAC(connection=scpi_replay('session.log', realtime=True))   # with the recorded reply delays
+
+The replay feeds back the recorded replies, each one as soon as the client has written as many bytes
+as had been written before it in the recording (with realtime, also not before the recorded delay
+between that write and the reply). The commands written do not have to be batched as in the recording,
+and with strict=True they must match the recorded ones byte for byte.
+Each connect() (or reconnect()) moves to the next connection of the recording.
+"""
+
+import collections
+import time
+
+from .redpitaya_scpi import scpi, read_log
+
+
+class _replay_socket (object):
+    """Socket-like object serving the replies of one recorded connection."""
+
+    def __init__(self, records, realtime=False, strict=False):
+        self.realtime = realtime
+        self.strict = strict
+        self._expected = bytearray()            # bytes written in the recording
+        self._replies = collections.deque()     # (bytes written before, delay after that write (s), data)
+        t_tx = None
+        for kind, t, data in records:
+            if kind == 'tx':
+                self._expected += data
+                t_tx = t
+            elif kind == 'rx':
+                self._replies.append((len(self._expected), t - t_tx if t_tx is not None else 0.0, data))
+        self._sent = 0
+        self._writes = collections.deque()      # (bytes written so far, time.perf_counter()) of the writes
+        self._data = b''                        # reply being consumed
+        self._closed = False
+
+    def _write_time(self, offset):
+        # time at which the client had written offset bytes
+        while len(self._writes) > 1 and self._writes[1][0] <= offset:
+            self._writes.popleft()
+        for sent, t in self._writes:
+            if sent >= offset:
+                return t
+        return time.perf_counter()
+
+    def sendall(self, data):
+        if self._closed:
+            raise ConnectionError('SCPI >> replay: write on a closed connection')
+        if self.strict:
+            expected = bytes(self._expected[self._sent:self._sent + len(data)])
+            if expected != bytes(data):
+                raise ValueError('SCPI >> replay: command {!r:s} differs from the recorded {!r:s}'.format(bytes(data), expected))
+        self._sent += len(data)
+        self._writes.append((self._sent, time.perf_counter()))
+
+    def ready(self):
+        """Return True if a reply can be received without waiting."""
+        if self._data:
+            return True
+        if not self._replies:
+            return False
+        offset, delay, _ = self._replies[0]
+        if self._sent < offset:
+            return False
+        return not self.realtime or time.perf_counter() >= self._write_time(offset) + delay
+
+    def recv(self, bufsize, flags=0):
+        if not self._data:
+            if not self._replies:
+                return b''      # end of the recorded connection: closed by the server
+            offset, delay, data = self._replies[0]
+            if self._sent < offset:
+                raise ConnectionError('SCPI >> replay: waiting for a reply to commands not written yet')
+            if self.realtime:
+                dt = self._write_time(offset) + delay - time.perf_counter()
+                if dt > 0:
+                    time.sleep(dt)
+            self._replies.popleft()
+            self._data = data
+            if not data:
+                return b''
+        out = self._data[:bufsize]
+        self._data = self._data[bufsize:]
+        return out
+
+    def recv_into(self, view):
+        data = self.recv(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._closed = True
+
+
+class scpi_replay (scpi):
+    """scpi connection replaying a session log recorded with scpi(..., record=path)."""
+
+    def __init__(self, path, realtime=False, strict=False):
+        self.path = path
+        self.realtime = realtime
+        self.strict = strict
+        self._connections = collections.deque()     # records of each recorded connection
+        for kind, t, data in read_log(path):
+            if kind == 'connect':
+                self._connections.append((data.decode('utf-8'), []))
+            elif self._connections:
+                self._connections[-1][1].append((kind, t, data))
+        if not self._connections:
+            raise ValueError('SCPI >> replay: no connection recorded in {!s:s}'.format(path))
+        host, port = self._connections[0][0].rsplit(':', 1)
+        super().__init__(host, port=int(port))
+
+    def _open(self):
+        if not self._connections:
+            raise ConnectionRefusedError('SCPI >> replay: no more connections recorded in {!s:s}'.format(self.path))
+        _, records = self._connections.popleft()
+        return _replay_socket(records, realtime=self.realtime, strict=self.strict)
+
+    def is_alive(self):
+        return self._socket is not None and not self._socket._closed
+
+    def rx_ready(self):
+        return bool(self._rx_buff) or (self._socket is not None and self._socket.ready())
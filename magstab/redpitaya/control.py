@@ -1,21 +1,23 @@
-import numpy as np
-from time import sleep
-import matplotlib.pyplot as plt
-from pyrpl import Pyrpl
+'''Feedforward (FF) and feedback (FB) setup of the Red Pitaya, with pyrpl:
+
+    p, modules = setup()        # connects and configures asg0/1, iq0/1/2, pid0/1 from the presets
+
+Importing this module has no side effect: pyrpl (and numpy) are only imported by the functions using them.
+'''
+
+from magstab.redpitaya.waveforms import comb, upload    # absolute: the file also runs as a script
+
+HOSTNAME = '172.16.10.75'
+
+def connect(hostname=HOSTNAME):
+    from pyrpl import Pyrpl
+    return Pyrpl(hostname=hostname, config='', gui=False)
 
-p = Pyrpl(hostname='172.16.10.75', config='', gui=False)
 
 def dds_function(fext=49.98,  q=1.56, W=128):
-    import numpy as np
-    N = 2**14
-    f0 = q*fext
-    k = int(np.round(N/2 * f0/fext))
-    k0 = 1 # a >0 delay must be set because output is set to 1st value of data array while waiting for trigger
-    assert k0 + k + W < N
-    x = np.zeros(N, dtype='float64')
-    x[k0:k0 + W] = 1.0
-    x[k0 + k:k0 + k + W] = -1.0
-    return x
+    '''Comb 1,0,0,...,-1,0,0,... of the FF asg0, see waveforms.comb (memoized). Returns a copy of the samples
+    '''
+    return comb(fext, q, W).data.copy()
 
 preset_asg0 = dict([('waveform', 'dc'),
              ('amplitude', 0.95),
@@ -97,27 +99,35 @@ preset_pid1 = dict([('input', 'out2'),
              ('differential_mode_enabled', False)])
 
 
-# asg1 : to add a DC component *after* band-pass-filters
-ff_asg1 = p.rp.asg1
-ff_asg1.setup(**preset_asg1)
 
-# asg0 : comb 1,0,0,...,-1,0,0,... for FF, synced on external trigger (mains)
-ff_asg0 = p.rp.asg0
-ff_asg0.setup(**preset_asg0)
-ff_asg0.data = dds_function()
+# module name --> preset, in the order they are applied
+PRESETS = dict([('asg1', preset_asg1),     # asg1 : to add a DC component *after* band-pass-filters
+                ('asg0', preset_asg0),     # asg0 : comb 1,0,0,...,-1,0,0,... for FF, synced on external trigger (mains)
+                ('iq0', preset_iq0),       # iq0, iq1, iq2 : three demodulators used as band-pass filters on asg0, output on out2
+                ('iq1', preset_iq1),
+                ('iq2', preset_iq2),
+                ('pid1', preset_pid1),     # pid1 to copy out2 (of FF) to out1 if we want to use a single shunt path for both FB and FF
+                ('pid0', preset_pid0)])    # pid0 : PID for FB
+
+
+def setup(p=None, hostname=HOSTNAME, mirror=None):
+    '''Configures the FF and FB modules with the presets, on pyrpl instance p (connects to hostname if None).
+    With mirror (mirror.Mirror of p.rp), only the attributes differing from the mirrored state are written.
+    Returns p and the modules, by name
+    '''
+    if p is None:
+        p = connect(hostname)
+
+    if mirror is None:
+        for name, preset in PRESETS.items():
+            getattr(p.rp, name).setup(**preset)
+    else:
+        mirror.apply(PRESETS)
+    upload(p.rp.asg0, comb())       # only the words that differ from the asg memory
 
-# iq0, iq1, iq2 : three demodulators used as band-pass filters on asg0, output on out2
-ff_iq0 = p.rp.iq0
-ff_iq1 = p.rp.iq1
-ff_iq2 = p.rp.iq2
-ff_iq0.setup(**preset_iq0)
-ff_iq1.setup(**preset_iq1)
-ff_iq2.setup(**preset_iq2)
+    modules = dict(ff_asg0=p.rp.asg0, ff_asg1=p.rp.asg1, ff_iq0=p.rp.iq0, ff_iq1=p.rp.iq1, ff_iq2=p.rp.iq2, fb_pid0=p.rp.pid0, fb_pid1=p.rp.pid1)
+    return p, modules
 
-# pid1 to copy out2 (of FF) to out1 if we want to use a single shunt path for both FB and FF
-fb_pid1 = p.rp.pid1
-fb_pid1.setup(**preset_pid1)
 
-# pid0 : PID for FB
-fb_pid0 = p.rp.pid0
-fb_pid0.setup(**preset_pid0)
\ No newline at end of file
+if __name__ == '__main__':
+    p, modules = setup()
@@ -0,0 +1,214 @@
+'''Tracking of the mains (line) frequency by the feedforward: the asg0 comb frequency and the iq
+band-pass filters on its harmonics follow the drift of the grid frequency.
+
+    tracker = Tracker(p.rp)         # line frequency from the trigger timestamps of the scope (ext trigger)
+    tracker.start()                 # polls in a thread, retunes when the frequency moves by a table step
+    tracker.f                       # current estimate (Hz)
+    tracker.stop()
+
+    tracker = Tracker(p.rp, source=lambda: stream.trigger_timestamp, lock=stream.lock)   # with a stream.ScopeStream
+
+The settings of the modules are precomputed (RetuneTable) over a grid of line frequencies: at runtime,
+a new estimate is only rounded to a row of the table, whose presets are applied through a
+mirror.Mirror (only the registers that changed are written). The comb index of the asg0 waveform is
+part of the table, for an asg0 at fixed frequency (waveforms.upload then only writes the moved pulse).
+The pyrpl client is not thread-safe: the tracker holds lock around its accesses to the board (reading
+the source, retuning), the lock of the other users of the board, e.g. the stream.lock of a scope stream.
+
+The frequency is measured from timestamps (FPGA clock cycles) of triggers on the mains edges:
+an integer number of periods lies between two of them, found by rounding with the previous estimate.
+It can also be measured on a scope trace of the mains, see frequency_from_trace().
+'''
+
+import collections
+import threading
+import time
+
+from .mirror import Mirror
+from .waveforms import N, comb, upload
+
+CLOCK = 125e6       # Hz, FPGA clock of the timestamps
+F_NOMINAL = 50.0    # Hz, nominal line frequency
+
+
+
+def frequency_from_timestamps(t0: int, t1: int, f=F_NOMINAL, clock=CLOCK):
+    '''Returns the frequency of triggers with timestamps t0 and t1 (clock cycles, t1 after t0),
+    and the number of periods between them, found by rounding with the approximate frequency f.
+    Returns (None, 0) if they are less than one period apart
+    '''
+    dt = (t1 - t0) % 2**64
+    n = int(round(dt * f / clock))
+    if n < 1:
+        return None, 0
+    return n * clock / dt, n
+
+def frequency_from_trace(x, dt: float):
+    '''Returns the frequency (Hz) of a trace x of the mains (samples dt s apart), from its rising
+    zero crossings (linearly interpolated, mean removed). None with less than two crossings
+    '''
+    import numpy as np
+    x = np.asarray(x, dtype=np.float64)
+    x = x - x.mean()
+    i = np.flatnonzero((x[:-1] < 0) & (x[1:] >= 0))
+    if len(i) < 2:
+        return None
+    t = (i + x[i] / (x[i] - x[i + 1])) * dt
+    return (len(t) - 1) / (t[-1] - t[0])
+
+
+class RetuneTable(object):
+    '''Settings of the feedforward modules over a grid of line frequencies, from fmin to fmax by step (Hz):
+        asg0 frequency: q*f, or asg_frequency if given (the comb index then follows f)
+        comb index: k of waveforms.comb, position of the second pulse (half a line period after the first)
+        iq frequency and phase: for each iq module, name --> (harmonic, phase at nominal (deg), delay (s)),
+            frequency harmonic*f and phase shifted by the delay to compensate at that frequency
+    '''
+
+    def __init__(self, iqs: dict, fmin=49.8, fmax=50.2, step=1e-3, q=1.56, W=128, asg_frequency=None, f_nominal=F_NOMINAL):
+        assert fmax > fmin and step > 0
+        self.iqs = dict(iqs)
+        self.fmin = fmin
+        self.step = step
+        self.q = q
+        self.W = W
+        self.f_nominal = f_nominal
+        n = int(round((fmax - fmin) / step)) + 1
+        self.f = [fmin + i * step for i in range(n)]
+        self.k = []         # comb index, per row
+        self.presets = []   # module name --> preset, per row
+        for f in self.f:
+            presets = {}
+            if asg_frequency is None:
+                presets['asg0'] = {'frequency': q * f}
+                self.k.append(int(round(N/2 * q)))
+            else:
+                self.k.append(int(round(N/2 * asg_frequency / f)))
+            for name, (harmonic, phase, delay) in self.iqs.items():
+                presets[name] = {'frequency': harmonic * f,
+                                 'phase': (phase + 360.0 * harmonic * (f - f_nominal) * delay) % 360.0}
+            self.presets.append(presets)
+
+    @classmethod
+    def from_presets(cls, presets=None, **kwargs):
+        '''Table for the iq modules of presets (control.PRESETS by default): harmonics from their frequencies,
+        phases as set, no delay
+        '''
+        from .control import PRESETS
+        presets = PRESETS if presets is None else presets
+        f_nominal = kwargs.get('f_nominal', F_NOMINAL)
+        iqs = {name: (int(round(preset['frequency'] / f_nominal)), preset['phase'], 0.0)
+               for name, preset in presets.items() if name.startswith('iq')}
+        return cls(iqs, **kwargs)
+
+    def __len__(self):
+        return len(self.f)
+
+    def row(self, f: float) -> int:
+        '''Returns the row of the table nearest to line frequency f (first or last one out of the grid)
+        '''
+        return min(max(int(round((f - self.fmin) / self.step)), 0), len(self.f) - 1)
+
+    def waveform(self, row: int):
+        '''Returns the asg0 comb of a row (memoized by waveforms.comb, the rows with the same index share it)
+        '''
+        return comb(self.f_nominal, 2 * self.k[row] / N, self.W)
+
+
+class Tracker(object):
+    '''Tracks the line frequency and retunes the feedforward modules of rp (pyrpl RedPitaya) with table.
+    source() returns the timestamp (clock cycles) of the last trigger on the mains, the scope's by default
+    (triggered on the mains, ext_positive_edge, and re-armed by its user, e.g. a scope stream).
+    The estimate is averaged over the triggers of the last window s. A new row of the table is applied
+    once the estimate is hysteresis steps beyond half a step from the current row.
+    lock is held for every access to the board, to share it with other threads (e.g. stream.lock)
+    '''
+
+    def __init__(self, rp, table=None, mirror=None, source=None, window=0.5, hysteresis=0.25, lock=None):
+        self.rp = rp
+        self.table = RetuneTable.from_presets() if table is None else table
+        names = sorted({name for presets in self.table.presets for name in presets})
+        self.mirror = Mirror(rp, names) if mirror is None else mirror
+        self.source = (lambda: rp.scope.trigger_timestamp) if source is None else source
+        self.window = window
+        self.hysteresis = hysteresis
+        self.lock = threading.RLock() if lock is None else lock
+        self.f = None           # estimate of the line frequency (Hz)
+        self.t_estimate = None  # time.monotonic() of the estimate
+        self.row = None         # row of the table applied
+        self.error = None       # last exception raised by the polling thread
+        self.n_polls = 0
+        self.n_retunes = 0
+        self.n_writes = 0       # attributes written (comb uploads not included)
+        self._timestamps = collections.deque()  # (timestamp, periods since the first one, time.monotonic())
+        self._stop = threading.Event()
+        self._thread = None
+
+    def poll(self):
+        '''Reads the trigger timestamp and, if there is a new one, updates the estimate and retunes.
+        Returns the estimate (None before the first two timestamps)
+        '''
+        self.n_polls += 1
+        with self.lock:
+            ts = int(self.source())
+        now = time.monotonic()
+        stamps = self._timestamps
+        if stamps and ts == stamps[-1][0]:
+            return self.f
+        if stamps:
+            _, n = frequency_from_timestamps(stamps[-1][0], ts, self.f or self.table.f_nominal)
+            if n == 0:
+                return self.f
+            stamps.append((ts, stamps[-1][1] + n, now))
+        else:
+            stamps.append((ts, 0, now))
+        while len(stamps) > 2 and now - stamps[1][2] >= self.window:
+            stamps.popleft()
+        if len(stamps) >= 2:
+            (t0, n0, _), (t1, n1, _) = stamps[0], stamps[-1]
+            self.f = (n1 - n0) * CLOCK / ((t1 - t0) % 2**64)
+            self.t_estimate = now
+            self.update(self.f)
+        return self.f
+
+    def update(self, f: float) -> dict:
+        '''Applies the row of the table for line frequency f, unless the current row is still within
+        the hysteresis. Returns the attributes written, by module name
+        '''
+        table = self.table
+        if self.row is not None and abs(f - table.f[self.row]) <= table.step * (0.5 + self.hysteresis):
+            return {}
+        row = table.row(f)
+        if row == self.row:
+            return {}
+        with self.lock:
+            written = self.mirror.apply(table.presets[row])
+            # on every retune, not only when the comb index changes: a setup() of asg0 elsewhere rewrites its
+            # memory; upload() writes nothing if the comb is still there, only the moved pulse otherwise
+            upload(self.rp.asg0, table.waveform(row))
+        self.row = row
+        self.n_retunes += 1
+        self.n_writes += sum(len(w) for w in written.values())
+        return written
+
+    def start(self, interval=0.1):
+        '''Polls every interval s in a thread
+        '''
+        assert self._thread is None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print('RP >> mains tracker: poll failed: {0!s:s}'.format(e))
+                self.error = e
@@ -0,0 +1,146 @@
+'''Local mirror of the state of pyrpl modules (asg, iq, pid, ...), to apply presets by writing
+only the attributes that differ from the current state:
+
+    mirror = Mirror(p.rp, ['asg0', 'asg1', 'iq0', 'iq1', 'iq2', 'pid0', 'pid1'])   # one bulk read per module
+    mirror['iq0']['phase']                  # cached, no access to the board
+    mirror.apply({'iq0': preset_iq0, 'pid0': preset_pid0})    # writes the changed attributes only
+
+The mirror is only coherent as long as the modules are changed through it: after changes made
+elsewhere (pyrpl GUI, another script), call refresh().
+The changed attributes are set one by one, not with the module's setup(): pyrpl's setup() always ends
+with the module's _setup(), which e.g. rewrites the whole waveform of an asg (and glitches its output)
+or synchronizes the iqs.
+'''
+
+import time
+
+_missing = object()
+
+
+
+def _descriptor(module, name):
+    for cls in type(module).__mro__:
+        if name in cls.__dict__:
+            return cls.__dict__[name]
+    return None
+
+def _plain_register(desc) -> bool:
+    # registers read as one word, decoded by to_python(): these are read in bulk
+    from pyrpl.attributes import BaseRegister
+    return isinstance(desc, BaseRegister) and type(desc).get_value is BaseRegister.get_value
+
+def _same(a, b) -> bool:
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+    try:
+        return bool(a == b)
+    except ValueError:      # arrays
+        return False
+
+
+class ModuleMirror(object):
+    '''Mirror of the setup attributes of one pyrpl module
+    '''
+    MAX_GAP = 64    # words: registers further apart are read in separate blocks
+
+    def __init__(self, module, names=None):
+        self.module = module
+        self.names = list(module._setup_attributes if names is None else names)
+        self._state = {}
+        self._requested = {}    # attribute --> (last value written, state read back: the module may round it)
+        self.n_reads = 0        # reads from the board (one per bulk block or attribute)
+        self.n_writes = 0       # attributes written
+        self.refresh()
+
+    def refresh(self):
+        '''Reads the state of the module: registers in bulk (one read per block of neighbouring registers),
+        other attributes one by one
+        '''
+        module = self.module
+        registers, others = [], []
+        for name in self.names:
+            desc = _descriptor(module, name)
+            (registers if desc is not None and _plain_register(desc) else others).append((name, desc))
+        state = {}
+        registers.sort(key=lambda item: item[1].address)
+        block = []
+        for name, desc in registers + [(None, None)]:
+            if block and (desc is None or desc.address - block[-1][1].address > 4 * self.MAX_GAP):
+                start = block[0][1].address
+                values = module._reads(start, (block[-1][1].address - start) // 4 + 1)
+                self.n_reads += 1
+                for n, d in block:
+                    value = int(values[(d.address - start) // 4])
+                    if d.bitmask is not None:
+                        value &= d.bitmask
+                    state[n] = d.to_python(module, value)
+                block = []
+            if desc is not None:
+                block.append((name, desc))
+        for name, desc in others:
+            state[name] = getattr(module, name)
+            self.n_reads += 1
+        self._state = state
+        self.t_refresh = time.monotonic()
+
+    def __getitem__(self, name):
+        return self._state[name]
+
+    def state(self) -> dict:
+        return dict(self._state)
+
+    def diff(self, preset: dict) -> dict:
+        '''Returns the attributes of preset differing from the current state (or from the last value written)
+        '''
+        out = {}
+        for name, value in preset.items():
+            state = self._state.get(name, _missing)
+            if _same(value, state):
+                continue
+            requested = self._requested.get(name)
+            if requested is not None and _same(value, requested[0]) and _same(state, requested[1]):
+                continue
+            out[name] = value
+        return out
+
+    def apply(self, preset: dict) -> dict:
+        '''Sets the attributes of preset that changed, if any, in the order of the module's setup attributes.
+        The state of the written attributes is read back (it may be rounded by the module).
+        Returns the attributes written.
+        '''
+        changed = self.diff(preset)
+        if changed:
+            order = {name: i for i, name in enumerate(self.module._setup_attributes)}
+            for name in sorted(changed, key=lambda name: order.get(name, len(order))):
+                setattr(self.module, name, changed[name])
+            self.n_writes += len(changed)
+            for name, value in changed.items():
+                self._state[name] = getattr(self.module, name)
+                self._requested[name] = (value, self._state[name])
+                self.n_reads += 1
+        return changed
+
+
+class Mirror(object):
+    '''Mirrors of several modules of a pyrpl RedPitaya (p.rp), by module name
+    '''
+
+    def __init__(self, rp, names):
+        self.rp = rp
+        self.modules = {name: ModuleMirror(getattr(rp, name)) for name in names}
+
+    def __getitem__(self, name) -> ModuleMirror:
+        return self.modules[name]
+
+    def refresh(self):
+        for mirror in self.modules.values():
+            mirror.refresh()
+
+    def state(self) -> dict:
+        return {name: mirror.state() for name, mirror in self.modules.items()}
+
+    def apply(self, presets: dict) -> dict:
+        '''Applies presets (module name --> preset dict), in order, writing only what changed.
+        Returns the attributes written, by module name
+        '''
+        return {name: self.modules[name].apply(preset) for name, preset in presets.items()}
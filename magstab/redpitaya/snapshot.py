@@ -0,0 +1,141 @@
+'''Snapshot and restore of the configuration of the pyrpl modules of a Red Pitaya (asg, iq, pid, scope),
+including the asg waveforms, to a versioned .npz file:
+
+    snapshot(p.rp, 'day.npz')
+    ...
+    restore(p.rp, 'night.npz')      # only the modules differing from the snapshot are written
+
+Each module of a snapshot carries a hash of its content (setup attributes and waveform), compared with
+the hash of the current state to skip the modules that already match. With a mirror.Mirror of the
+modules, the current state is taken from the mirror (no access to the board) and only the attributes
+that differ are written.
+The asg waveforms are kept as the words of the asg memory, read back from the board in one block
+(pyrpl only remembers the words it wrote, not what a board set up by another process holds).
+'''
+
+import hashlib
+import json
+import time
+
+FORMAT = 'magstab-redpitaya-snapshot'
+VERSION = 1
+
+MODULES = ('asg0', 'asg1', 'iq0', 'iq1', 'iq2', 'pid0', 'pid1', 'scope')
+
+
+
+def _plain(value):
+    # JSON-serializable form of a setup attribute, None if it has none
+    if hasattr(value, 'tolist'):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        items = [_plain(v) for v in value]
+        return None if any(v is None for v in items) else items
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return None
+
+def _asg_words(module):
+    '''Returns the words of the waveform memory of an asg module (uint32 array), as read back from
+    the board, None for other modules
+    '''
+    import numpy as np
+    if not hasattr(module, '_DATA_OFFSET'):
+        return None
+    words = np.asarray(module._reads(module._DATA_OFFSET, module.data_length), dtype=np.uint32)
+    module._writtendata = words     # what pyrpl remembers as written, for waveforms.upload()
+    return words
+
+def _write_asg_words(module, words):
+    module._writes(module._DATA_OFFSET, words)
+    module._writtendata = words     # as pyrpl does, since it does not read the waveform back
+
+def module_hash(attributes: dict, words=None) -> str:
+    '''Returns the content hash of a module: of its setup attributes, and of its waveform if any
+    '''
+    h = hashlib.sha256(json.dumps(attributes, sort_keys=True).encode('utf-8'))
+    if words is not None:
+        h.update(words.tobytes())
+    return h.hexdigest()[:16]
+
+
+def _attributes(module, mirror=None) -> dict:
+    if mirror is not None:
+        state = mirror.state()
+    else:
+        state = {name: getattr(module, name) for name in module._setup_attributes}
+    attributes = {}
+    for name, value in state.items():
+        value = _plain(value)
+        if value is not None:
+            attributes[name] = value
+    return attributes
+
+def _mirror_of(mirror, name):
+    if mirror is None:
+        return None
+    return mirror.modules.get(name)
+
+
+def snapshot(rp, path=None, modules=MODULES, mirror=None) -> dict:
+    '''Captures the configuration of modules (names of pyrpl modules of rp), from mirror if given.
+    Writes it to path (.npz) if given, and returns it as a dict:
+        {'format', 'version', 'time', 'modules': {name: {'attributes', 'hash'}}, 'waveforms': {name: words}}
+    '''
+    import numpy as np
+    snap = {'format': FORMAT, 'version': VERSION, 'time': time.time(), 'modules': {}, 'waveforms': {}}
+    for name in modules:
+        module = getattr(rp, name)
+        attributes = _attributes(module, _mirror_of(mirror, name))
+        words = _asg_words(module)
+        snap['modules'][name] = {'attributes': attributes, 'hash': module_hash(attributes, words)}
+        if words is not None:
+            snap['waveforms'][name] = words
+    if path is not None:
+        header = {k: snap[k] for k in ('format', 'version', 'time', 'modules')}
+        arrays = {'waveform_' + name: words for name, words in snap['waveforms'].items()}
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, header=np.frombuffer(json.dumps(header).encode('utf-8'), dtype=np.uint8), **arrays)
+    return snap
+
+def load(path) -> dict:
+    '''Reads a snapshot file, see snapshot()
+    '''
+    import numpy as np
+    with np.load(path) as f:
+        snap = json.loads(f['header'].tobytes().decode('utf-8'))
+        if snap.get('format') != FORMAT:
+            raise ValueError('{0} is not a Red Pitaya snapshot'.format(path))
+        if snap.get('version', 0) > VERSION:
+            raise ValueError('{0}: snapshot version {1} is newer than supported ({2})'.format(path, snap['version'], VERSION))
+        snap['waveforms'] = {key[len('waveform_'):]: f[key] for key in f.files if key.startswith('waveform_')}
+    return snap
+
+def restore(rp, snap, mirror=None, force=False) -> list:
+    '''Restores a snapshot (dict, or path of a snapshot file) on the modules of rp.
+    Modules whose current content hash matches the snapshot are skipped unless force is True;
+    with a mirror, only the attributes differing from the mirrored state are written.
+    Returns the names of the modules written.
+    '''
+    if not isinstance(snap, dict):
+        snap = load(snap)
+    restored = []
+    for name, content in snap['modules'].items():
+        module = getattr(rp, name)
+        module_mirror = _mirror_of(mirror, name)
+        words = _asg_words(module)
+        if not force and module_hash(_attributes(module, module_mirror), words) == content['hash']:
+            continue
+        attributes = content['attributes']
+        if module_mirror is not None and not force:
+            module_mirror.apply(attributes)
+        else:
+            module.setup(**attributes)
+            if module_mirror is not None:
+                module_mirror.refresh()
+        saved = snap['waveforms'].get(name)
+        words = _asg_words(module)  # again: setup() of an asg, or setting its waveform, rewrites its memory
+        if saved is not None and (force or words is None or not (words.shape == saved.shape and (words == saved).all())):
+            _write_asg_words(module, saved)
+        restored.append(name)
+    return restored
@@ -0,0 +1,216 @@
+'''Continuous acquisition of the pyrpl scope in the background, into a ring buffer of traces:
+
+    stream = ScopeStream(p.rp.scope, depth=32)
+    stream.start()
+    first = stream.change(settle=2.0, input1='in1', input2='out1')   # frames acquired after the change only
+    for seq, frame in stream.iter(30, start=first):     # frame: view of the ring, frame[0] ch1, frame[1] ch2 (V)
+        ...                                             # processing overlaps the acquisition of the next frames
+    stream.dropped          # frames overwritten before the consumer got them
+    stream.close()
+
+A thread keeps arming the scope, waits for the trace, reads it (raw words, one block per channel)
+and re-arms the scope before converting the trace into the next slot of the ring: the scope is
+acquiring again while the trace is converted and while the consumer processes the previous ones.
+The consumer gets views of the ring (no copy), valid until depth - 1 newer frames have been acquired:
+valid(seq) tells whether a view is still intact, e.g. after copying or processing it. A consumer lagging
+more than that resumes from the newest frame, the frames skipped are counted as dropped.
+
+The pyrpl client is not thread-safe: while the stream runs, other accesses to the board must hold
+stream.lock (or go through change()). The trigger timestamp of the last frame is kept in
+stream.trigger_timestamp, e.g. as the source of a mains.Tracker without another access to the scope
+(with lock=stream.lock, for its retunes).
+'''
+
+import threading
+import time
+
+N = 2**14   # samples of a scope trace
+
+
+
+class ScopeStream(object):
+
+    def __init__(self, scope, depth=32, dtype='float32', poll=1e-3):
+        import numpy as np
+        assert depth >= 2
+        self.scope = scope
+        self.depth = depth
+        self.poll = poll            # s between checks of the end of the acquisition
+        self.lock = threading.RLock()   # held for every access to the board
+        self.data = np.zeros((depth, 2, N), dtype=dtype)    # ring of frames: ch1, ch2 (V)
+        self.seq = np.full(depth, -1, dtype=np.int64)       # frame number held by each slot
+        self.timestamps = np.zeros(depth, dtype=np.uint64)  # trigger timestamp of each slot (clock cycles)
+        self.times = np.zeros(depth)                        # time.monotonic() at the end of each acquisition
+        self.trigger_timestamp = None   # of the last frame
+        self.dropped = 0            # frames overwritten before being consumed
+        self.error = None           # last exception raised by the acquisition thread
+        self._cond = threading.Condition()
+        self._produced = 0          # frames committed to the ring
+        self._in_flight = 0         # frame read from the board, being converted
+        self._cursor = 0            # next frame for the consumer
+        self._rearm = True
+        self._hold_until = 0.0      # time.monotonic() before which the scope is not armed (settling)
+        self._readout = 0.0         # s, total time reading traces from the board
+        self._t_start = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def frames(self) -> int:
+        '''Number of frames acquired
+        '''
+        return self._produced
+
+    def start(self):
+        assert self._thread is None
+        self._stop.clear()
+        self._rearm = True
+        self._t_start = time.monotonic()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            with self._cond:
+                self._cond.notify_all()
+
+    close = stop
+
+    def change(self, settle=0.0, **attributes) -> int:
+        '''Sets attributes of the scope (e.g. input1='in1'), abandons the acquisition in progress and waits
+        settle s before arming again. Returns the number of the first frame acquired after the change
+        '''
+        with self.lock:
+            for name, value in attributes.items():
+                setattr(self.scope, name, value)
+            self._hold_until = time.monotonic() + settle
+            self._rearm = True
+            with self._cond:
+                return self._produced + self._in_flight
+
+    def valid(self, seq: int) -> bool:
+        '''Returns True if frame seq is still in the ring, False once its slot is being overwritten:
+        to be checked after using a view, which may have been torn meanwhile
+        '''
+        return self._produced - self.depth < seq < self._produced
+
+    def next(self, timeout=None):
+        '''Returns (frame number, view of the frame) of the next frame for the consumer, waiting for it
+        if needed. None on timeout, or once the stream is stopped and all its frames consumed
+        '''
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._produced > self._cursor or self._thread is None, timeout):
+                return None
+            if self._produced <= self._cursor:
+                return None
+            if self._cursor <= self._produced - self.depth:
+                # lagging: resumes from the newest frame, the one overwritten last (not the next one)
+                newest = self._produced - 1
+                self.dropped += newest - self._cursor
+                self._cursor = newest
+            seq = self._cursor
+            self._cursor += 1
+            return seq, self.data[seq % self.depth]
+
+    def iter(self, n: int, start=None, timeout=None):
+        '''Yields (frame number, view) for n consecutive new frames, from frame start if given
+        (frames before start are skipped without counting as dropped)
+        '''
+        if start is not None:
+            with self._cond:
+                self._cursor = max(self._cursor, start)
+        for _ in range(n):
+            frame = self.next(timeout)
+            if frame is None:
+                return
+            yield frame
+
+    def read(self, n: int, start=None, timeout=None) -> list:
+        '''Returns the views of n consecutive new frames, see iter()
+        '''
+        return [frame for _, frame in self.iter(n, start, timeout)]
+
+    def stats(self) -> dict:
+        '''Returns the numbers of frames acquired and dropped, the frame rate (frames/s since start())
+        and the mean time reading a trace from the board (s)
+        '''
+        with self._cond:
+            elapsed = time.monotonic() - self._t_start if self._t_start is not None else 0.0
+            return {
+                'frames': self._produced,
+                'dropped': self.dropped,
+                'rate': self._produced / elapsed if elapsed > 0 else 0.0,
+                'readout': self._readout / self._produced if self._produced else None,
+            }
+
+    def _read_trace(self):
+        # raw trace of the triggered acquisition, as pyrpl's scope._data_ch1/2 (without their conversions)
+        scope = self.scope
+        shift = (scope._write_pointer_trigger + scope._trigger_delay_register + 1) % N
+        timestamp = scope.trigger_timestamp
+        ch1 = scope._reads(0x10000, N)
+        ch2 = scope._reads(0x20000, N)
+        return shift, timestamp, ch1, ch2
+
+    def _store(self, slot, shift, ch1, ch2):
+        import numpy as np
+        out = self.data[slot]
+        for c, raw in enumerate((ch1, ch2)):
+            x = np.asarray(raw, dtype=np.int32)
+            x = np.where(x >= 2**13, x - 2**14, x)
+            # rolled by -shift: the trace starts at the write pointer of the trigger (plus delay)
+            np.multiply(x[shift:], 1.0 / 2**13, out=out[c, :N - shift], casting='same_kind')
+            np.multiply(x[:shift], 1.0 / 2**13, out=out[c, N - shift:], casting='same_kind')
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                trace = None
+                with self.lock:
+                    if self._rearm:
+                        if time.monotonic() < self._hold_until:
+                            trace = False
+                        else:
+                            self.scope._start_trace_acquisition()
+                            self._rearm = False
+                    elif self.scope.curve_ready():
+                        t0 = time.perf_counter()
+                        trace = self._read_trace()
+                        self._readout += time.perf_counter() - t0
+                        self.scope._start_trace_acquisition()   # next acquisition while this one is stored
+                        with self._cond:
+                            self._in_flight = 1
+                if not trace:
+                    self._stop.wait(self.poll)
+                    continue
+                shift, timestamp, ch1, ch2 = trace
+                with self._cond:
+                    seq = self._produced
+                    slot = seq % self.depth
+                    self.seq[slot] = -1     # the slot is being overwritten
+                self._store(slot, shift, ch1, ch2)
+                with self._cond:
+                    self.seq[slot] = seq
+                    self.timestamps[slot] = timestamp
+                    self.times[slot] = time.monotonic()
+                    self.trigger_timestamp = timestamp
+                    self._produced += 1
+                    self._in_flight = 0
+                    self._cond.notify_all()
+            except Exception as e:
+                print('RP >> scope stream: acquisition failed: {0!s:s}'.format(e))
+                self.error = e
+                with self._cond:
+                    self._in_flight = 0
+                self._rearm = True
+                self._stop.wait(0.1)
@@ -0,0 +1,95 @@
+'''Library of the feedforward waveforms of the asg modules, memoized by their parameters,
+and delta upload to the asg memory:
+
+    upload(p.rp.asg0, comb(fext=49.98, q=1.56, W=128))     # first time: the whole buffer
+    upload(p.rp.asg0, comb(fext=49.98, q=1.60, W=128))     # only the samples around the moved pulse
+
+A Waveform holds the samples (-1 to 1), the words written to the asg memory (converted as pyrpl does)
+and a content hash. upload() skips a waveform identical to the one in the asg, and otherwise only writes
+the ranges of words that changed, compared with the words pyrpl remembers as written on the host.
+'''
+
+import functools
+import hashlib
+
+N = 2**14   # samples of the asg memory
+MERGE = 64  # changed ranges closer than this (words) are written as one
+
+
+
+class Waveform(object):
+
+    def __init__(self, data):
+        import numpy as np
+        data = np.array(data, dtype=np.float64)
+        assert data.shape == (N,)
+        # conversion of pyrpl's asg data setter
+        words = np.array(np.round((2**13 - 1) * data), dtype=np.int32)
+        words[words >= 2**13] = 2**13 - 1
+        words[words < 0] += 2**14
+        words[words < 0] = -(2**13)
+        words = np.array(words, dtype=np.uint32)
+        data.setflags(write=False)
+        words.setflags(write=False)
+        self.data = data
+        self.words = words
+        self.hash = hashlib.sha256(words.tobytes()).hexdigest()[:16]
+
+
+@functools.lru_cache(maxsize=64)
+def comb(fext=49.98, q=1.56, W=128, harmonics=()) -> Waveform:
+    '''Comb 1,0,0,...,-1,0,0,... synced on the external trigger (mains at fext): pulses of W samples,
+    the second one k = N/2*q samples after the first, plus sine harmonics of the buffer period with
+    amplitudes harmonics (1st, 2nd, ...). Memoized: the same parameters return the same Waveform
+    '''
+    import numpy as np
+    f0 = q*fext
+    k = int(np.round(N/2 * f0/fext))
+    k0 = 1 # a >0 delay must be set because output is set to 1st value of data array while waiting for trigger
+    assert k0 + k + W < N
+    x = np.zeros(N, dtype='float64')
+    x[k0:k0 + W] = 1.0
+    x[k0 + k:k0 + k + W] = -1.0
+    if harmonics:
+        phase = 2 * np.pi * np.arange(N) / N
+        for h, a in enumerate(harmonics, 1):
+            if a:
+                x += a * np.sin(h * phase)
+    return Waveform(x)
+
+
+def changed_ranges(old, new, merge=MERGE) -> list:
+    '''Returns the (start, stop) ranges of the indices where the arrays old and new differ,
+    ranges closer than merge being merged
+    '''
+    import numpy as np
+    idx = np.flatnonzero(np.asarray(old) != np.asarray(new))
+    if len(idx) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(idx) > merge)
+    starts = np.concatenate(([idx[0]], idx[breaks + 1]))
+    stops = np.concatenate((idx[breaks], [idx[-1]])) + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+def upload(asg, waveform, merge=MERGE) -> int:
+    '''Writes waveform (Waveform, or array of N samples) to the memory of pyrpl asg module asg,
+    only the ranges that changed. Returns the number of words written
+    '''
+    if not isinstance(waveform, Waveform):
+        waveform = Waveform(waveform)
+    old = getattr(asg, '_writtendata', None)
+    uploaded = getattr(asg, '_waveform_uploaded', None)     # (words object, hash) of the last upload
+    if uploaded is not None and old is uploaded[0] and uploaded[1] == waveform.hash:
+        return 0
+    if old is None or len(old) != N:
+        ranges = [(0, N)]
+    else:
+        ranges = changed_ranges(old, waveform.words, merge)
+    n = 0
+    for start, stop in ranges:
+        asg._writes(asg._DATA_OFFSET + 4*start, waveform.words[start:stop])
+        n += stop - start
+    # pyrpl does not read the waveform back but remembers it, see asg.data
+    asg._writtendata = waveform.words
+    asg._waveform_uploaded = (waveform.words, waveform.hash)
+    return n
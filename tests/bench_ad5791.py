@@ -0,0 +1,134 @@
+'''Micro-benchmarks of the pure-Python AD5791 helpers run on every DAC access.
+
+No hardware needed. From the repository root:
+
+    python -m tests.bench_ad5791              # compare with the stored baseline, exit 1 on regression
+    python -m tests.bench_ad5791 --update     # store the current timings as the new baseline
+    python -m tests.bench_ad5791 --scaling    # also run the 1 to 10^6 values scaling series, scalar and vectorized
+
+Timings are in ns per call (best of several repeats). The baseline is machine dependent:
+regenerate it with --update on the machine used for the comparison.
+'''
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import timeit
+import types
+
+from magstab.dac.ad5791 import (
+    VREFP, VREFN, AD5791_W, AD5791_R, AD5791_REG_DAC,
+    _volt_to_code, _code_to_volt, _code_to_tuple, _tuple_to_hexstr, _parse_write, _parse_read,
+    _transfer_msgs, _Transaction, pprint_code,
+    _volt_to_code_array, _codes_to_frames, _parse_read_array,
+)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_ad5791_baseline.json')
+THRESHOLD = 1.5     # a benchmark regresses when slower than THRESHOLD x baseline
+REPEAT = 5
+SCALING = [10**k for k in range(7)]    # number of values in the scaling series
+
+V = 4.876543
+CODE = _volt_to_code(V)
+FRAME = AD5791_W | AD5791_REG_DAC | CODE
+TUPLE = _code_to_tuple(FRAME)
+RX_BUFF = '{{{0},{1},{2}}}'.format(*TUPLE)
+
+# message list of a V write already prepared on the server: only the data frame changes between writes
+PREPARED = _Transaction(3)
+RP_S = types.SimpleNamespace(prepared=PREPARED)
+VOLTS = itertools.cycle((V, -V))
+
+BENCHMARKS = {
+    '_volt_to_code':    lambda: _volt_to_code(V),
+    '_code_to_volt':    lambda: _code_to_volt(CODE),
+    '_code_to_tuple':   lambda: _code_to_tuple(FRAME),
+    '_tuple_to_hexstr': lambda: _tuple_to_hexstr(TUPLE),
+    '_parse_write':     lambda: _parse_write(FRAME),
+    '_parse_read':      lambda: _parse_read(RX_BUFF),
+    'pprint_code':      lambda: pprint_code(FRAME),
+    # everything the client computes for one DAC.V write (codes and SCPI command strings)
+    'V_write_msgs':     lambda: _transfer_msgs([AD5791_W | AD5791_REG_DAC | _volt_to_code(V), AD5791_R | AD5791_REG_DAC, 0]),
+    'V_write_prepared': lambda: PREPARED.msgs(RP_S, [AD5791_W | AD5791_REG_DAC | _volt_to_code(next(VOLTS)), AD5791_R | AD5791_REG_DAC, 0]),
+}
+
+
+def bench(f, repeat=REPEAT) -> float:
+    '''Returns the best time per call of f, in ns
+    '''
+    timer = timeit.Timer(f)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def scaling(sizes=SCALING):
+    '''Encodes n voltages into V write commands and parses n readbacks, for each n in sizes,
+    one value at a time and with the vectorized codec.
+    Returns {n: (ns per value, ns per value vectorized)}.
+    '''
+    out = {}
+    for n in sizes:
+        volts = [VREFN + (VREFP - VREFN) * i / n for i in range(n)]
+        rx_buffs = [RX_BUFF] * n
+        def encode():
+            for v in volts:
+                _parse_read(RX_BUFF)
+                _parse_write(AD5791_W | AD5791_REG_DAC | _volt_to_code(v))
+        def encode_array():
+            _parse_read_array(rx_buffs)
+            _codes_to_frames(AD5791_W | AD5791_REG_DAC | _volt_to_code_array(volts)).tobytes()
+        repeat = 1 if n >= 10**5 else 3
+        t = min(timeit.repeat(encode, repeat=repeat, number=1))
+        t_array = min(timeit.repeat(encode_array, repeat=repeat, number=1))
+        out[n] = (t / n * 1e9, t_array / n * 1e9)
+    return out
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--update', action='store_true', help='store current timings as baseline')
+    parser.add_argument('--scaling', action='store_true', help='run the scaling series')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='regression ratio (default {0})'.format(THRESHOLD))
+    args = parser.parse_args(argv)
+
+    results = {name: bench(f) for name, f in BENCHMARKS.items()}
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            baseline = json.load(f)
+
+    regressions = []
+    print('{0:20s} {1:>12s} {2:>12s} {3:>8s}'.format('benchmark', 'ns/call', 'baseline', 'ratio'))
+    for name, t in results.items():
+        ref = baseline.get(name)
+        ratio = t / ref if ref else float('nan')
+        flag = ''
+        if ref and ratio > args.threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{0:20s} {1:12.1f} {2:>12s} {3:8.2f}{4}'.format(name, t, '{0:.1f}'.format(ref) if ref else '-', ratio, flag))
+    print('client-side ceiling on DAC.V rate: {0:,.0f} writes/s'.format(1e9 / results['V_write_prepared']))
+
+    if args.scaling:
+        print('\n{0:>10s} {1:>12s} {2:>14s} {3:>12s} {4:>14s}'.format('values', 'ns/value', 'total (s)', 'array ns/v', 'array tot (s)'))
+        for n, (t, t_array) in scaling().items():
+            print('{0:10d} {1:12.1f} {2:14.6f} {3:12.1f} {4:14.6f}'.format(n, t, t * n * 1e-9, t_array, t_array * n * 1e-9))
+
+    if args.update:
+        with open(BASELINE, 'w') as f:
+            json.dump({name: round(t, 1) for name, t in results.items()}, f, indent=4)
+            f.write('\n')
+        print('baseline written to {0}'.format(BASELINE))
+        return 0
+
+    if regressions:
+        print('{0:d} regression(s): {1}'.format(len(regressions), ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
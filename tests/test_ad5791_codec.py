@@ -0,0 +1,62 @@
+'''The vectorized codec of ad5791 (numpy arrays) must give the same codes, voltages and frames as the
+scalar conversions, VREFP/VREFN scaling and truncation included. From the repository root:
+
+    python -m pytest tests/test_ad5791_codec.py
+'''
+
+import pytest
+
+from magstab.dac import ad5791
+
+np = pytest.importorskip('numpy')
+
+N_CODES = 2**20
+
+
+@pytest.fixture
+def voltages():
+    rng = np.random.default_rng(0)
+    v = rng.uniform(ad5791.VREFN, ad5791.VREFP, 20000)
+    return np.concatenate(([ad5791.VREFN, ad5791.VREFP, 0.0, -0.0], v))
+
+@pytest.fixture
+def codes():
+    rng = np.random.default_rng(1)
+    return np.concatenate(([0, 1, N_CODES // 2 - 1, N_CODES // 2, N_CODES - 1],
+                           rng.integers(0, N_CODES, 20000))).astype(np.uint32)
+
+
+def test_volt_to_code_array(voltages):
+    expected = [ad5791._volt_to_code(float(v)) for v in voltages]
+    assert ad5791._volt_to_code_array(voltages).tolist() == expected
+
+def test_volt_to_code_array_endpoints():
+    codes = ad5791._volt_to_code_array([ad5791.VREFN, ad5791.VREFP])
+    assert codes.tolist() == [ad5791._volt_to_code(ad5791.VREFN), ad5791._volt_to_code(ad5791.VREFP)]
+    assert codes.tolist() == [N_CODES // 2, N_CODES // 2 - 1]     # two's complement
+    with pytest.raises(AssertionError):
+        ad5791._volt_to_code_array([ad5791.VREFP + 1e-3])
+
+def test_code_to_volt_array(codes):
+    expected = [ad5791._code_to_volt(int(c)) for c in codes]
+    assert ad5791._code_to_volt_array(codes).tolist() == expected
+
+def test_codes_to_frames(codes):
+    words = ad5791.AD5791_W | ad5791.AD5791_REG_DAC | codes
+    frames = ad5791._codes_to_frames(words)
+    assert frames.shape == (len(codes), 3)
+    assert [tuple(row) for row in frames.tolist()] == [ad5791._code_to_tuple(int(c)) for c in words]
+    assert ad5791._frames_to_codes(frames).tolist() == words.tolist()
+    assert ad5791._frames_to_codes(frames.tobytes()).tolist() == words.tolist()
+
+def test_codes_to_frames_scalar():
+    c = ad5791.AD5791_W | ad5791.AD5791_REG_SFT | ad5791.AD5791_BIT_LDAC
+    for code in (c, np.uint32(c), np.array(c)):     # 0-d input is one frame
+        frames = ad5791._codes_to_frames(code)
+        assert frames.shape == (1, 3)
+        assert tuple(frames[0].tolist()) == ad5791._code_to_tuple(c)
+
+def test_parse_read_array(codes):
+    buffs = ['{' + ','.join(str(w) for w in ad5791._code_to_tuple(int(c))) + '}' for c in codes]
+    assert ad5791._parse_read_array(buffs).tolist() == [ad5791._parse_read(buff) for buff in buffs]
+    assert ad5791._parse_read_array([]).tolist() == []
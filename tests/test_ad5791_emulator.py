@@ -0,0 +1,228 @@
+'''Regression tests of ad5791.DAC against the local emulator of the Red Pitaya SCPI server
+(ad5791_emulator.Emulator): no hardware needed. From the repository root:
+
+    python -m pytest tests/test_ad5791_emulator.py
+
+Each test runs its own emulator and connection pool, voltages are checked on the emulated registers
+(the output itself is grounded until op_gnd is cleared).
+'''
+
+import gc
+
+import pytest
+
+from magstab.dac import ad5791
+from magstab.dac.ad5791_emulator import Emulator
+from magstab.dac.group import DACGroup
+from magstab.external.redpitaya_scpi import scpi, scpi_pool
+from magstab.external.redpitaya_scpi_replay import scpi_replay
+
+DEV_X = '/dev/spidev1.0'
+DEV_Y = '/dev/spidev1.1'
+LSB = (ad5791.VREFP - ad5791.VREFN) / (2**20 - 1)
+
+
+@pytest.fixture
+def emu():
+    with Emulator() as emu:
+        yield emu
+
+@pytest.fixture
+def pool():
+    pool = scpi_pool()
+    yield pool
+    pool.close()
+
+
+def volt(code: int) -> float:
+    return ad5791._code_to_volt(code & ad5791.AD5791_MASK_DATA)
+
+def emulated(emu, dac, reg='dac') -> float:
+    '''Voltage of register reg (dac or input) of the emulated device of dac, once the commands
+    sent before are executed (writes are pipelined, without reply)
+    '''
+    dac._txrx(['*OPC?'])
+    return volt(getattr(emu.device(dac._spi_dev), reg))
+
+def commands(rp_s) -> dict:
+    return {header: c['count'] for header, c in rp_s.stats()['commands'].items()}
+
+
+def test_write_read_V(emu, pool):
+    dac = ad5791.DAC(*emu.address, pool=pool)
+    for v in (1.2345, -3.0, 0.0, 9.5):
+        dac.V = v
+        assert abs(dac.V - v) <= LSB
+        assert abs(emulated(emu, dac) - v) <= LSB
+    assert dac.read_reg(ad5791.AD5791_REG_DAC, verify=True) == dac.reg_dac
+    assert dac.verify()
+    assert emu.errors == []
+
+def test_delayed_trig(emu, pool):
+    dac = ad5791.DAC(*emu.address, pool=pool)
+    dac.V = 1.0
+    dac.delayed_trig = True
+    dac.V = 2.0
+    assert abs(emulated(emu, dac, 'input') - 2.0) <= LSB
+    assert abs(emulated(emu, dac) - 1.0) <= LSB
+    dac.soft_ldac()
+    assert abs(emulated(emu, dac) - 2.0) <= LSB
+
+
+def test_shadow(emu, pool):
+    dac = ad5791.DAC(*emu.address, pool=pool)
+    dac.V = 2.5
+    dac.tristate = False
+    emulated(emu, dac)
+    n_commands, n_passes = emu.n_commands, emu.n_passes
+    # reads of the registers written or read back are served from the shadow
+    for _ in range(10):
+        dac.V, dac.tristate, dac.op_gnd, dac.reg_clr
+    assert (emu.n_commands, emu.n_passes) == (n_commands, n_passes)
+    # verified reads go to the hardware, one transaction each
+    dac.read_reg(ad5791.AD5791_REG_DAC, verify=True)
+    assert emu.n_passes == n_passes + 1
+    # and so do reads older than max_age
+    dac.max_age = 0.0
+    dac.tristate
+    dac.tristate
+    assert emu.n_passes == n_passes + 3
+
+def test_shadow_invalidate(emu, pool):
+    dac = ad5791.DAC(*emu.address, pool=pool)
+    dac.V = 2.5
+    dac.soft_reset()
+    emulated(emu, dac)
+    n_passes = emu.n_passes
+    assert dac.tristate     # power-on default, read back from the hardware after the reset
+    assert emu.n_passes == n_passes + 1
+
+
+def test_prepared_list(emu, pool):
+    dac = ad5791.DAC(*emu.address, pool=pool)
+    dac.V = 0.0
+    dac.rp_s.enable_stats()
+    n = 20
+    for i in range(n):
+        dac.V = 1.0 + 0.01 * i
+    counts = commands(dac.rp_s)
+    # the list of the transfer is created once, then only the TX of the DAC frame is sent with each write
+    assert 'SPI:MSG:CREATE' not in counts and 'SPI:INIT:DEV' not in counts
+    assert counts['SPI:PASS'] == n
+    assert sum(count for header, count in counts.items() if header.startswith('SPI:MSG')) == n
+    assert abs(emulated(emu, dac) - (1.0 + 0.01 * (n - 1))) <= LSB
+    assert emu.errors == []
+
+
+def test_play(emu, pool):
+    np = pytest.importorskip('numpy')
+    dac = ad5791.DAC(*emu.address, pool=pool)
+    samples = np.linspace(-1.0, 1.0, 1000)
+    result = dac.play(samples, rate=10e3, chunk=128)
+    assert result['samples'] == 1000
+    assert result['chunks'] == 8
+    assert abs(emulated(emu, dac) - 1.0) <= LSB
+    assert abs(dac.V - 1.0) <= LSB
+    assert dac.read_reg(ad5791.AD5791_REG_DAC, verify=True) == dac.reg_dac
+    assert emu.errors == []
+
+def test_play_stop(emu, pool):
+    np = pytest.importorskip('numpy')
+    dac = ad5791.DAC(*emu.address, pool=pool)
+    chunks = []
+    result = dac.play(np.zeros(1000), rate=10e3, chunk=100, stop=lambda: chunks.append(1) or len(chunks) > 3)
+    assert result['samples'] == 300 and result['chunks'] == 3
+    dac.V = 1.5     # the connection is still usable after playback
+    assert abs(emulated(emu, dac) - 1.5) <= LSB
+
+def test_play_interrupted(emu, pool):
+    np = pytest.importorskip('numpy')
+    dac = ad5791.DAC(*emu.address, spi_dev=DEV_X, pool=pool)
+    other = ad5791.DAC(*emu.address, spi_dev=DEV_Y, pool=pool)
+    sock = dac.rp_s._socket
+    chunks = []
+    def stop():
+        chunks.append(1)
+        if len(chunks) > 3:
+            raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        dac.play(np.zeros(1000), rate=10e3, chunk=100, stop=stop)
+    assert dac.rp_s._socket is sock     # the connection shared with other is kept
+    other.V = 2.0
+    assert other.verify() and abs(emulated(emu, other) - 2.0) <= LSB
+    assert dac.clock_freq == ad5791.SPI_SPEED
+    assert emu.errors == []
+
+
+def test_group(emu, pool):
+    dx = ad5791.DAC(*emu.address, spi_dev=DEV_X, pool=pool)
+    dy = ad5791.DAC(*emu.address, spi_dev=DEV_Y, pool=pool)
+    assert dx.rp_s is dy.rp_s
+    group = DACGroup([dx, dy])
+    for vx, vy in ((1.0, 2.0), (-1.5, 0.5)):
+        last = group.set((vx, vy))
+        assert last is group.last
+        assert len(last['times']) == 2 and min(last['times']) == 0.0
+        assert 0.0 <= last['skew'] <= last['duration']
+        assert abs(emulated(emu, dx) - vx) <= LSB
+        assert abs(emulated(emu, dy) - vy) <= LSB
+    assert [round(v, 4) for v in group.V] == [-1.5, 0.5]
+    # each device keeps its SPI settings: switching between them does not send the full setup again
+    dx.rp_s.enable_stats()
+    group.set((0.0, 0.0))
+    assert 'SPI:SET:SPEED' not in commands(dx.rp_s)
+    assert emu.errors == []
+
+def test_group_timeout(emu, pool):
+    dx = ad5791.DAC(*emu.address, spi_dev=DEV_X, pool=pool)
+    dy = ad5791.DAC(*emu.address, spi_dev=DEV_Y, pool=pool)
+    group = DACGroup([dx, dy], timeout=0.2)
+    emu.latency = 1.0   # the board is alive but does not reply in time
+    with pytest.raises(OSError):
+        group.set((1.0, 2.0))
+    emu.latency = 0.0
+    group.set((1.0, 2.0))   # on a new connection
+    assert abs(emulated(emu, dy) - 2.0) <= LSB
+
+
+def test_reconnect(emu, pool):
+    dac = ad5791.DAC(*emu.address, pool=pool)
+    dac.V = 1.0
+    dac.rp_s._socket.close()    # connection dropped
+    dac.V = 2.0
+    assert abs(emulated(emu, dac) - 2.0) <= LSB
+    assert dac.read_reg(ad5791.AD5791_REG_DAC, verify=True) == dac.reg_dac
+    assert emu.errors == []
+
+def test_close(emu, pool):
+    dac = ad5791.DAC(*emu.address, pool=pool)
+    rp_s = dac.rp_s
+    pool.close()
+    assert rp_s.session is None and not rp_s.is_alive()
+    del dac
+    gc.collect()
+    assert not rp_s.is_alive()  # not reopened to release the SPI
+
+
+def _session(dac):
+    out = []
+    for i in range(20):
+        dac.V = 1.0 + 0.01 * i
+    out.append(dac.read_registers())
+    dac.tristate = False
+    out.append(dac.reg_ctl)
+    out.append(dac.verify())
+    return out
+
+def test_record_replay(emu, tmp_path):
+    log = str(tmp_path / 'session.log')
+    rp_s = scpi(emu.address[0], port=emu.address[1], record=log)
+    dac = ad5791.DAC(connection=rp_s)
+    recorded = _session(dac)
+    del dac
+    gc.collect()
+    rp_s.close()
+    assert rp_s._recorder._file.closed
+    for realtime in (False, True):
+        dac = ad5791.DAC(connection=scpi_replay(log, realtime=realtime, strict=True))
+        assert _session(dac) == recorded
@@ -0,0 +1,87 @@
+'''Calibrated conversions of calibration.Calibration: scalar and vectorized lookups agree, truncate
+like the uncalibrated conversion, and handle the ends of the table. From the repository root:
+
+    python -m pytest tests/test_calibration.py
+'''
+
+import pytest
+
+from magstab.dac import ad5791
+from magstab.dac.calibration import N_CODES, Calibration, make_table, save_table
+
+np = pytest.importorskip('numpy')
+
+_MSB = N_CODES // 2
+
+
+def _calibration(tmp_path, name, table):
+    path = str(tmp_path / name)
+    save_table(path, table)
+    return Calibration(path)
+
+@pytest.fixture(scope='module')
+def ideal(tmp_path_factory):
+    return _calibration(tmp_path_factory.mktemp('calibration'), 'ideal.npy', make_table())
+
+@pytest.fixture(scope='module')
+def measured(tmp_path_factory):
+    # smooth INL of a few LSB, as a real DAC: the scalar lookup walks away from the ideal code
+    u = np.arange(N_CODES) / N_CODES
+    inl = 3.0 * np.sin(2 * np.pi * u) + 0.5 * np.sin(2 * np.pi * 37 * u)
+    return _calibration(tmp_path_factory.mktemp('calibration'), 'measured.npy', make_table(inl=inl))
+
+def random_voltages(calibration, n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(calibration.vrefn, calibration.vrefp, n)
+
+
+@pytest.mark.parametrize('name', ['ideal', 'measured'])
+def test_scalar_matches_array(name, request):
+    calibration = request.getfixturevalue(name)
+    v = random_voltages(calibration)
+    expected = calibration.volt_to_code_array(v).tolist()
+    assert [calibration.volt_to_code(float(x)) for x in v] == expected
+
+@pytest.mark.parametrize('name', ['ideal', 'measured'])
+def test_truncation(name, request):
+    # each entry of the table gives its own code, just below it the code before
+    calibration = request.getfixturevalue(name)
+    table = calibration.table
+    rng = np.random.default_rng(1)
+    for u in rng.integers(1, N_CODES, 200).tolist():
+        v = float(table[u])
+        assert calibration.volt_to_code(v) == u ^ _MSB
+        assert calibration.volt_to_code(float(np.nextafter(v, -np.inf))) == (u - 1) ^ _MSB
+        assert calibration.volt_to_code_array([v]).tolist() == [u ^ _MSB]
+        assert calibration.code_to_volt(u ^ _MSB) == v
+
+def test_ideal_table(ideal):
+    # codes of the uncalibrated conversion, up to float rounding at the code boundaries
+    v = random_voltages(ideal, 20000)
+    codes = ideal.volt_to_code_array(v).astype(np.int64) ^ _MSB
+    expected = ad5791._volt_to_code_array(v).astype(np.int64) ^ _MSB
+    assert np.abs(codes - expected).max() <= 1
+    assert np.mean(codes == expected) > 0.999
+    # exactly, away from the boundaries
+    centers = (ideal.table[:-1] + ideal.table[1:]) / 2
+    u = np.random.default_rng(2).integers(0, N_CODES - 1, 2000)
+    assert [ideal.volt_to_code(float(x)) for x in centers[u]] == [ad5791._volt_to_code(float(x)) for x in centers[u]]
+
+@pytest.mark.parametrize('name', ['ideal', 'measured'])
+def test_endpoints(name, request):
+    calibration = request.getfixturevalue(name)
+    vrefn, vrefp = calibration.vrefn, calibration.vrefp
+    assert calibration.volt_to_code(vrefn) == _MSB                 # lowest code, two's complement
+    assert calibration.volt_to_code(vrefp) == (N_CODES - 1) ^ _MSB
+    assert calibration.volt_to_code_array([vrefn, vrefp]).tolist() == [_MSB, (N_CODES - 1) ^ _MSB]
+    for v in (vrefn - 1e-3, vrefp + 1e-3):
+        with pytest.raises(AssertionError):
+            calibration.volt_to_code(v)
+        with pytest.raises(AssertionError):
+            calibration.volt_to_code_array([v])
+
+def test_without_table():
+    calibration = Calibration()
+    v = random_voltages(calibration, 1000)
+    assert calibration.volt_to_code_array(v).tolist() == [ad5791._volt_to_code(float(x)) for x in v]
+    assert [calibration.volt_to_code(float(x)) for x in v] == [ad5791._volt_to_code(float(x)) for x in v]
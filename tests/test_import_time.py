@@ -0,0 +1,81 @@
+'''Imports of the magstab modules must be fast and free of side effects: no output, no shell spawned,
+no connection, and no heavy dependency loaded (these are imported by the functions needing them).
+
+Each module is imported in a fresh interpreter. From the repository root:
+
+    python -m pytest tests/test_import_time.py
+    python -m tests.test_import_time
+'''
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BUDGET = 0.2    # s per module import, generous for an import compiling its sources (no .pyc)
+
+MODULES = [
+    'magstab',
+    'magstab.external.redpitaya_scpi',
+    'magstab.external.redpitaya_scpi_async',
+    'magstab.external.redpitaya_scpi_replay',
+    'magstab.dac.ad5791',
+    'magstab.dac.ad5791_async',
+    'magstab.dac.ad5791_emulator',
+    'magstab.dac.calibration',
+    'magstab.dac.group',
+    'magstab.dac.ramp',
+    'magstab.dac.writer',
+    'magstab.redpitaya.control',
+    'magstab.redpitaya.mains',
+    'magstab.redpitaya.mirror',
+    'magstab.redpitaya.snapshot',
+    'magstab.redpitaya.stream',
+    'magstab.redpitaya.waveforms',
+]
+
+HEAVY = ['numpy', 'matplotlib', 'pyrpl', 'scipy', 'textual']
+
+_PROBE = '''
+import os, sys, time
+def _forbidden(*args, **kwargs):
+    raise RuntimeError('shell spawned at import')
+os.system = _forbidden
+t0 = time.perf_counter()
+import {module}
+dt = time.perf_counter() - t0
+sys.stderr.write(repr((dt, sorted(m for m in {heavy!r} if m in sys.modules))))
+'''
+
+
+def import_probe(module):
+    '''Imports module in a new interpreter, returns its import time (s), the heavy modules it loaded and its output
+    '''
+    proc = subprocess.run(
+        [sys.executable, '-c', _PROBE.format(module=module, heavy=HEAVY)],
+        cwd=ROOT, capture_output=True, text=True, timeout=60,
+    )
+    assert proc.returncode == 0, proc.stderr
+    dt, heavy = eval(proc.stderr.strip().splitlines()[-1])
+    return dt, heavy, proc.stdout
+
+
+@pytest.mark.parametrize('module', MODULES)
+def test_import(module):
+    dt, heavy, output = import_probe(module)
+    assert output == '', 'import prints: {0!r}'.format(output)
+    assert heavy == [], 'heavy modules loaded at import: {0}'.format(heavy)
+    assert dt < BUDGET, 'import took {0:.3f} s, budget {1:.3f} s'.format(dt, BUDGET)
+
+
+if __name__ == '__main__':
+    failed = 0
+    for module in MODULES:
+        dt, heavy, output = import_probe(module)
+        ok = not output and not heavy and dt < BUDGET
+        failed += not ok
+        print('{0:40s} {1:8.1f} ms {2}{3}'.format(module, dt * 1e3, 'ok' if ok else 'FAIL', ' ' + ', '.join(heavy) if heavy else ''))
+    sys.exit(1 if failed else 0)
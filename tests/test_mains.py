@@ -0,0 +1,125 @@
+'''Tracking of the mains frequency (magstab.redpitaya.mains) with stubs of the board: frequency estimates,
+rows of the retune table, hysteresis and comb uploads. From the repository root:
+
+    python -m pytest tests/test_mains.py
+'''
+
+import pytest
+
+from magstab.redpitaya.mains import CLOCK, RetuneTable, Tracker, frequency_from_timestamps, frequency_from_trace
+
+np = pytest.importorskip('numpy')
+
+from test_waveforms import StubAsg
+
+
+class StubMirror(object):
+    '''Records the presets applied, and returns them as written'''
+
+    def __init__(self):
+        self.applied = []
+
+    def apply(self, presets):
+        self.applied.append(presets)
+        return {name: dict(preset) for name, preset in presets.items()}
+
+
+class StubRP(object):
+
+    def __init__(self):
+        self.asg0 = StubAsg()
+
+
+def timestamps(f, periods, t0=12345):
+    '''Trigger timestamps (clock cycles) after each number of periods of the mains at f'''
+    return [t0 + int(round(n * CLOCK / f)) for n in periods]
+
+def make_tracker(**kwargs):
+    table = RetuneTable({'iq0': (1, 272.0, 1e-3), 'iq1': (7, 115.0, 0.0)})
+    return Tracker(StubRP(), table=table, mirror=StubMirror(), source=lambda: 0, **kwargs)
+
+
+def test_frequency_from_timestamps():
+    t0, t1 = timestamps(50.02, [0, 10])
+    f, n = frequency_from_timestamps(t0, t1)
+    assert n == 10 and f == pytest.approx(50.02, abs=1e-6)
+    f, n = frequency_from_timestamps(2**64 - 1000, (2**64 - 1000 + t1 - t0) % 2**64)     # counter wrap
+    assert n == 10 and f == pytest.approx(50.02, abs=1e-6)
+    assert frequency_from_timestamps(t0, t0 + 1000) == (None, 0)
+
+def test_frequency_from_trace():
+    dt = 1e-4
+    t = np.arange(20000) * dt
+    x = 0.3 + np.sin(2 * np.pi * 49.97 * t + 1.0)
+    assert frequency_from_trace(x, dt) == pytest.approx(49.97, abs=1e-3)
+    assert frequency_from_trace(np.ones(100), dt) is None
+
+
+def test_table():
+    table = RetuneTable({'iq0': (1, 272.0, 1e-3)}, fmin=49.8, fmax=50.2, step=1e-3)
+    assert len(table) == 401
+    assert table.row(49.8) == 0 and table.row(50.2) == 400
+    assert table.row(50.0004) == 200 and table.row(50.0006) == 201
+    assert table.row(40.0) == 0 and table.row(60.0) == 400
+    preset = table.presets[table.row(50.1)]
+    assert preset['asg0']['frequency'] == pytest.approx(1.56 * 50.1)
+    assert preset['iq0']['frequency'] == pytest.approx(50.1)
+    assert preset['iq0']['phase'] == pytest.approx(272.0 + 360.0 * 0.1 * 1e-3)
+    assert len(set(table.k)) == 1       # asg0 frequency follows f: same comb on all rows
+    fixed = RetuneTable({}, asg_frequency=78.0)
+    assert 'asg0' not in fixed.presets[0] and fixed.k[0] > fixed.k[-1]
+
+def test_hysteresis():
+    tracker = make_tracker()
+    table = tracker.table
+    assert tracker.update(50.0) != {}
+    row = tracker.row
+    assert tracker.update(50.0 + 0.7 * table.step) == {}     # within half a step plus the hysteresis
+    assert tracker.row == row
+    assert tracker.update(50.0 - 0.7 * table.step) == {}
+    assert tracker.update(50.0 + 0.8 * table.step) != {}
+    assert tracker.row == row + 1
+    assert tracker.n_retunes == 2 and len(tracker.mirror.applied) == 2
+
+def test_poll():
+    stamps = iter(timestamps(50.03, [0, 0, 5, 10, 15]))
+    tracker = make_tracker()
+    tracker.source = lambda: next(stamps)
+    assert tracker.poll() is None                       # first timestamp
+    assert tracker.poll() is None                       # same trigger again
+    assert tracker.poll() == pytest.approx(50.03, abs=1e-5)
+    assert tracker.row == tracker.table.row(50.03)
+    tracker.poll()
+    tracker.poll()
+    assert tracker.n_polls == 5 and tracker.n_retunes == 1
+
+def test_comb_uploaded_on_every_retune():
+    tracker = make_tracker()
+    asg = tracker.rp.asg0
+    tracker.update(50.0)
+    comb = tracker.table.waveform(tracker.row)
+    assert (asg.memory == comb.words).all()
+    asg.setup()                     # e.g. a setup() of asg0 elsewhere rewrites its memory
+    tracker.update(50.01)           # same comb index as the previous row
+    assert tracker.table.waveform(tracker.row) is comb
+    assert (asg.memory == comb.words).all()
+    n = len(asg.writes)
+    tracker.update(50.02)
+    assert len(asg.writes) == n     # comb still there: nothing written
+
+def test_lock():
+    class Lock(object):
+        def __init__(self):
+            self.held = 0
+        def __enter__(self):
+            self.held += 1
+        def __exit__(self, *exc):
+            self.held -= 1
+    lock = Lock()
+    tracker = make_tracker(lock=lock)
+    held = []
+    tracker.source = lambda: held.append(lock.held) or 0
+    tracker.mirror.apply = lambda presets: held.append(lock.held) or {}
+    tracker.poll()
+    tracker.update(50.0)
+    assert held == [1, 1] and lock.held == 0
@@ -3,6 +3,8 @@ from time import sleep
 import matplotlib.pyplot as plt
 from pyrpl import Pyrpl
 
+from magstab.redpitaya.stream import ScopeStream
+
 IP = '172.16.10.75'
 LINESTYLE = '-'
 LINEWIDTH = 0.75
@@ -37,34 +39,37 @@ def spectrum(x: float, rbw=0.9313225746154784) -> float:
     y = np.sqrt(np.abs(y)**2 * 2)   # this forumla ensures sum(x**2) == sum(y**2)
     return y/np.sqrt(rbw)           # now a spectral density in V/sqrt(Hz) : ensures sum(x**2) == sum(y**2) * rbw
 
-def plot_rp(scope, axes, ch1='in1', ch2='out1', label='', gain1=GAIN_BASEL, gain2=1, avg=1):
-    scope.input1 = ch1
-    scope.input2 = ch2
-    sleep(2)
-    x1, x2 = scope.single()
-    x1 /= gain1
-    x2 /= gain2
-    noise1 = np.std(x1)
-    noise2 = np.std(x2)
+def plot_rp(stream, axes, ch1='in1', ch2='out1', label='', gain1=GAIN_BASEL, gain2=1, avg=1):
+    # the scope keeps acquiring in the background (ScopeStream): each spectrum is computed while
+    # the next traces are acquired, from traces taken 2 s after the change of inputs
+    scope = stream.scope
     t = scope.times
     # fs = np.mean(np.diff(t))
     assert len(t) == N
     assert np.mean(np.diff(t)) == DECIMATION*TIME_RESOLUTION    # 1/sampling rate
     f = np.fft.rfftfreq(N, DECIMATION*TIME_RESOLUTION)
     rbw = 1/(DECIMATION*TIME_RESOLUTION*N)
-    y1 =  spectrum(x1, rbw)
-    y2 =  spectrum(x2, rbw)
-
-    y1_mean = y1
-    y2_mean = y2
-    for i in range(1, avg):
-        x1_, x2_ = scope.single()
-        x1_ /= gain1
-        x2_ /= gain2
+    first = stream.change(settle=2, input1=ch1, input2=ch2)
+    stream.start()
+
+    y1_mean = 0
+    y2_mean = 0
+    n_avg = 0
+    for seq, frame in stream.iter(avg, start=first):
+        x1_ = frame[0] / gain1      # copies: the frame is a view of the ring buffer
+        x2_ = frame[1] / gain2
+        if not stream.valid(seq):
+            continue                # overwritten while copied
+        if n_avg == 0:
+            x1, x2 = x1_, x2_
         y1_mean += spectrum(x1_, rbw)
         y2_mean += spectrum(x2_, rbw)
-    y1_mean /= avg
-    y2_mean /= avg
+        n_avg += 1
+    stream.stop()   # the other modules are set without the stream running (the pyrpl client is not thread-safe)
+    y1_mean /= n_avg
+    y2_mean /= n_avg
+    noise1 = np.std(x1)
+    noise2 = np.std(x2)
 
     noise1_ = np.sqrt(np.sum(y1_mean**2)*rbw/N)
     noise2_ = np.sqrt(np.sum(y2_mean**2)*rbw/N)
@@ -319,6 +324,7 @@ preset_scope = dict([('trace_average', 1),
 s = p.rp.scope
 s.setup(**preset_scope)
 s.duration = N*DECIMATION*TIME_RESOLUTION
+stream = ScopeStream(s)
 
 
 # Prepare plotting
@@ -366,7 +372,7 @@ ff_iq2.setup(**preset_iq2)
 fb_pid0.output_direct = 'off'
 ff_pid1.output_direct = 'off'
 ff_asg1.output_direct = preset_asg1['output_direct']    # because shunt PCB can't work below transistor threshold
-plot_rp(s, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, gain2=1, label='No FF nor FB', avg=AVERAGES)
+plot_rp(stream, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, gain2=1, label='No FF nor FB', avg=AVERAGES)
 
 
 
@@ -378,7 +384,7 @@ plot_rp(s, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, gain2=1, label='No FF no
 fb_pid0.output_direct = 'off'
 ff_pid1.output_direct = preset_pid1['output_direct']
 # ff_asg1.output_direct = preset_asg1['output_direct']
-plot_rp(s, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, label='FF only', avg=AVERAGES)
+plot_rp(stream, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, label='FF only', avg=AVERAGES)
 
 
 
@@ -391,7 +397,7 @@ plot_rp(s, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, label='FF only', avg=AVE
 fb_pid0.output_direct = preset_pid0['output_direct']
 ff_pid1.output_direct = 'off'
 # ff_asg1.output_direct = 'off'
-plot_rp(s, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, label='FB only', avg=AVERAGES)
+plot_rp(stream, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, label='FB only', avg=AVERAGES)
 
 
 
@@ -401,7 +407,7 @@ plot_rp(s, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, label='FB only', avg=AVE
 fb_pid0.output_direct = preset_pid0['output_direct']
 ff_pid1.output_direct = preset_pid1['output_direct']
 # ff_asg1.output_direct = 'off'
-plot_rp(s, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, label='FF + FB', avg=AVERAGES)
+plot_rp(stream, ax, ch1='in1', ch2='out1', gain1=GAIN_BASEL, label='FF + FB', avg=AVERAGES)
 
 
 
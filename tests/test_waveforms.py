@@ -0,0 +1,81 @@
+'''Waveform library and delta upload of magstab.redpitaya.waveforms, with a stub of a pyrpl asg module
+(no board needed). From the repository root:
+
+    python -m pytest tests/test_waveforms.py
+'''
+
+import pytest
+
+from magstab.redpitaya.waveforms import MERGE, N, Waveform, changed_ranges, comb, upload
+
+np = pytest.importorskip('numpy')
+
+
+class StubAsg(object):
+    '''Memory of an asg module, written by _writes() as pyrpl does'''
+    _DATA_OFFSET = 0x10000
+
+    def __init__(self):
+        self.memory = np.zeros(N, dtype=np.uint32)
+        self.writes = []    # (start, number of words)
+
+    def _writes(self, addr, values):
+        start = (addr - self._DATA_OFFSET) // 4
+        self.memory[start:start + len(values)] = values
+        self.writes.append((start, len(values)))
+
+    def setup(self):
+        # pyrpl's asg _setup() rewrites the waveform memory (waveform 'dc')
+        self.memory[:] = 0
+        self._writtendata = np.zeros(N, dtype=np.uint32)
+
+
+def test_changed_ranges():
+    old = np.zeros(1000)
+    assert changed_ranges(old, old) == []
+    new = old.copy()
+    new[[10, 11, 12, 500]] = 1
+    assert changed_ranges(old, new) == [(10, 13), (500, 501)]
+    new[10 + MERGE] = 1     # within merge of the first range
+    assert changed_ranges(old, new) == [(10, 11 + MERGE), (500, 501)]
+    assert changed_ranges(old, new, merge=1000) == [(10, 501)]
+
+def test_comb():
+    w = comb(50.0, 1.56, 128)
+    assert comb(50.0, 1.56, 128) is w                   # memoized
+    assert w.data.shape == (N,) and not w.data.flags.writeable
+    assert w.data[1:129].tolist() == [1.0] * 128 and w.data[0] == 0.0
+    assert (w.data == -1.0).sum() == 128
+    assert w.words[1] == 2**13 - 1 and w.words[w.data == -1.0][0] == 2**14 - (2**13 - 1)
+    assert comb(50.0, 1.60, 128).hash != w.hash
+
+def test_waveform_conversion():
+    w = Waveform(np.linspace(-1.0, 1.0, N))
+    assert w.words.min() >= 0 and w.words.max() < 2**14
+    assert w.words[N // 2] in (0, 2**14 - 1)
+
+def test_upload():
+    asg = StubAsg()
+    w1 = comb(50.0, 1.56, 128)
+    assert upload(asg, w1) == N     # first time: the whole buffer
+    assert (asg.memory == w1.words).all()
+    assert upload(asg, w1) == 0     # same waveform: nothing written
+    w2 = comb(50.0, 1.60, 128)
+    n = upload(asg, w2)             # only around the moved pulse
+    assert 0 < n < 2 * 128 + 2 * MERGE
+    assert (asg.memory == w2.words).all()
+
+def test_upload_after_setup():
+    asg = StubAsg()
+    w = comb(50.0, 1.56, 128)
+    upload(asg, w)
+    asg.setup()
+    assert upload(asg, w) == 2 * 128    # the pulses again, compared with the zeros pyrpl remembers
+    assert (asg.memory == w.words).all()
+
+def test_upload_array():
+    asg = StubAsg()
+    x = np.zeros(N)
+    x[100:200] = 0.5
+    upload(asg, x)
+    assert (asg.memory == Waveform(x).words).all()